@@ -32,6 +32,8 @@ if [ -n "$WEBDAV_URL" ] && [ -n "$WEBDAV_USERNAME" ] && [ -n "$WEBDAV_PASSWORD"
   "remote_dir": "$(echo "${REMOTE_DIR:-/}" | sed 's/\\/\\\\/g; s/"/\\"/g')",
   "check_interval": ${CHECK_INTERVAL:-600},
   "max_workers": ${THREADS:-10},
+  "list_workers": ${LIST_THREADS:-4},
+  "engine": "$(echo "${ENGINE:-thread}" | sed 's/\\/\\\\/g; s/"/\\"/g')",
   "replace_ip": "$(echo "${REPLACE_IP:-}" | sed 's/\\/\\\\/g; s/"/\\"/g')",
   "post_command": "",
   "web_port": ${WEB_PORT:-8080}
@@ -66,4 +68,4 @@ fi
 # 启动Web服务
 : ${WEB_PORT:="8080"}
 echo "启动Web服务在端口: ${WEB_PORT}"
-cd /app && python webdav_monitor_web.py --config-dir /config --port ${WEB_PORT} 
\ No newline at end of file
+cd /app && exec python webdav_monitor_web.py --config-dir /config --port ${WEB_PORT} 
\ No newline at end of file
@@ -11,6 +11,7 @@ from datetime import datetime
 import threading
 import queue
 import concurrent.futures
+import asyncio
 import subprocess
 import shlex
 import re
@@ -18,6 +19,26 @@ import socket
 import sys
 import ssl
 import sqlite3
+import json
+import hashlib
+import struct
+import tempfile
+import bisect
+import heapq
+import contextlib
+import signal
+from collections import deque
+from email.utils import parsedate_to_datetime, formatdate
+from lxml import etree
+from webdav3.urn import Urn
+from webdav3.exceptions import MethodNotSupported, RemoteResourceNotFound, ResponseErrorCode
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import aiohttp
+except ImportError:  # 可选依赖，只有asyncio引擎需要
+    aiohttp = None
 
 # 禁用所有潜在的代理配置
 if 'http_proxy' in os.environ:
@@ -79,17 +100,251 @@ try:
 except Exception as e:
     logging.warning(f"解析WebDAV服务器IP失败: {e}")
 
-def fix_path(parent_dir, path_item):
-    """修复路径，确保使用正确格式"""
-    # 如果路径已经是绝对路径，直接返回
-    if path_item.startswith('/'):
-        return path_item
-    
-    # 否则，拼接父目录和子项目
-    if parent_dir.endswith('/'):
-        return parent_dir + path_item
+# PROPFIND请求体：只请求扫描需要的属性，减少服务器端计算和响应体积
+PROPFIND_BODY = (
+    b'<?xml version="1.0" encoding="utf-8"?>'
+    b'<D:propfind xmlns:D="DAV:"><D:prop>'
+    b'<D:resourcetype/><D:getcontentlength/><D:getetag/><D:getlastmodified/>'
+    b'</D:prop></D:propfind>'
+)
+
+class DavEntry:
+    """PROPFIND响应中的单个条目"""
+    __slots__ = ('path', 'is_dir', 'size', 'etag', 'mtime')
+
+    def __init__(self, path, is_dir, size=None, etag=None, mtime=None):
+        self.path = path      # 远程路径（已解码，目录不带结尾的/）
+        self.is_dir = is_dir  # 是否为目录(collection)
+        self.size = size      # getcontentlength，目录或未知时为None
+        self.etag = etag      # getetag
+        self.mtime = mtime    # getlastmodified，转换为时间戳
+
+    def __repr__(self):
+        return f"DavEntry({self.path!r}, is_dir={self.is_dir}, size={self.size}, etag={self.etag!r}, mtime={self.mtime})"
+
+def parse_http_date(value):
+    """将HTTP日期(getlastmodified)转换为时间戳，无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except Exception:
+        return None
+
+def is_not_found(error):
+    """请求的远程资源是否不存在(404)"""
+    return isinstance(error, RemoteResourceNotFound) or (isinstance(error, ResponseErrorCode) and error.code == 404)
+
+# 释放响应时最多读完的剩余响应体大小，更大的响应体直接关闭连接
+DRAIN_LIMIT = 64 * 1024
+
+def release_response(response):
+    """释放流式响应，尽量把连接归还连接池
+
+    未读取的响应体直接close()会关闭连接，下次请求需要重新握手；304、错误页等剩余内容较小的
+    响应先读完再释放，连接可以复用。只有放弃较大的响应体(例如下载中途出错)时才关闭连接。
+    """
+    try:
+        length = response.headers.get('Content-Length')
+        if length is None or int(length) <= DRAIN_LIMIT:
+            remaining = DRAIN_LIMIT
+            while remaining > 0:
+                chunk = response.raw.read(min(remaining, 16384), decode_content=False)
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+    except Exception:
+        pass
+    response.close()
+
+def parse_retry_after(value):
+    """解析Retry-After响应头(秒数或HTTP日期)，返回需要等待的秒数，无法解析时返回None"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        timestamp = parse_http_date(value)
+        return max(0.0, timestamp - time.time()) if timestamp is not None else None
+
+def parse_dav_response(response_el, href_prefix=''):
+    """将multistatus中的一个<D:response>元素解析为DavEntry
+
+    :param response_el: <D:response>元素
+    :param href_prefix: 服务器地址中的路径前缀，从href中去除后得到远程路径
+    """
+    href = response_el.findtext('{DAV:}href')
+    if not href:
+        return None
+    path = urllib.parse.unquote(urllib.parse.urlsplit(href.strip()).path)
+    if href_prefix and path.startswith(href_prefix):
+        path = path[len(href_prefix):]
+    # 没有返回resourcetype时按href结尾的/判断
+    is_dir = path.endswith('/')
+    path = '/' + path.strip('/')
+
+    size = etag = mtime = None
+    for propstat in response_el.iterfind('{DAV:}propstat'):
+        # 只采用状态为200的属性，忽略服务器声明不存在(404)的属性
+        status = propstat.findtext('{DAV:}status') or ''
+        if status and ' 200 ' not in status + ' ':
+            continue
+        prop = propstat.find('{DAV:}prop')
+        if prop is None:
+            continue
+        resourcetype = prop.find('{DAV:}resourcetype')
+        if resourcetype is not None:
+            # 以resourcetype为准：按目录形式(带/)请求文件时，部分服务器返回的href也会带/
+            is_dir = resourcetype.find('{DAV:}collection') is not None
+        length = prop.findtext('{DAV:}getcontentlength')
+        if length:
+            try:
+                size = int(length)
+            except ValueError:
+                pass
+        etag = prop.findtext('{DAV:}getetag') or etag
+        mtime = parse_http_date(prop.findtext('{DAV:}getlastmodified')) or mtime
+
+    return DavEntry(path, is_dir, None if is_dir else size, etag, mtime)
+
+# 匹配形如 http://192.168.1.1:8080/ 或 http://10.0.0.1/ 的IP地址
+STRM_IP_PATTERN = re.compile(rb'http://(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(:\d+)?/')
+
+# 小于该大小的STRM文件在内存中完成下载和替换，一次性写入
+STRM_INMEMORY_MAX_SIZE = 1024 * 1024
+
+def rewrite_strm_bytes(data, replace_ip_with_domain):
+    """替换STRM内容中的IP为域名，保留端口号(如果有)，返回新的内容"""
+    if not replace_ip_with_domain:
+        return data
+    domain = replace_ip_with_domain.encode('utf-8')
+    return STRM_IP_PATTERN.sub(lambda m: b'http://' + domain + (m.group(2) or b'') + b'/', data)
+
+# mkstemp创建的文件权限为0600，替换前按umask改回普通文件的权限，媒体服务器等其他用户仍可读取
+FILE_UMASK = os.umask(0)
+os.umask(FILE_UMASK)
+
+def write_file_atomic(file_path, data):
+    """先写入临时文件再替换目标文件，读取方不会看到写了一半的内容
+
+    每次写入使用唯一的临时文件名：STRM替换线程和下载线程可能同时写同一个文件。
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.',
+                                    prefix=os.path.basename(file_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o666 & ~FILE_UMASK)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def quote_etag(etag):
+    """部分服务器(如wsgidav)在getetag中返回不带引号的etag，用于请求头时补上引号"""
+    if etag.startswith('"') or etag.startswith('W/"'):
+        return etag
+    return f'"{etag}"'
+
+def entry_validator(entry):
+    """返回可用于If-Range的校验值：强etag优先，否则使用修改时间；都没有时返回None"""
+    if entry is None:
+        return None
+    if entry.etag and not entry.etag.startswith('W/'):
+        return quote_etag(entry.etag)
+    if entry.mtime:
+        return formatdate(entry.mtime, usegmt=True)
+    return None
+
+def open_part_file(local_path, validator):
+    """准备断点续传的.part文件
+
+    :return: (.part路径, 已下载的字节数)；只有.part记录的校验值与validator相同时才续传
+    """
+    part_path = local_path + '.part'
+    try:
+        with open(part_path + '.validator', 'r', encoding='utf-8') as f:
+            saved = f.read()
+        if validator and saved == validator:
+            return part_path, os.path.getsize(part_path)
+    except OSError:
+        pass
+    return part_path, 0
+
+def start_part_file(part_path, validator):
+    """从头开始下载时记录.part对应的校验值，供之后续传时比较"""
+    validator_path = part_path + '.validator'
+    if validator:
+        with open(validator_path, 'w', encoding='utf-8') as f:
+            f.write(validator)
+    elif os.path.exists(validator_path):
+        os.remove(validator_path)
+
+def finish_part_file(part_path, local_path, expected_size):
+    """确认.part已完整后替换到目标位置；不完整时抛出异常并保留.part供续传"""
+    size = os.path.getsize(part_path)
+    if expected_size is not None and size != expected_size:
+        raise IOError(f"下载不完整: 已接收 {size} 字节，应为 {expected_size} 字节")
+    os.replace(part_path, local_path)
+    try:
+        os.remove(part_path + '.validator')
+    except OSError:
+        pass
+
+RECENT_FILES_LIMIT = 100  # 扫描统计中保留的最近新增文件数
+
+# 分段下载时每个分块的大小，中断后只需重新下载未完成的分块
+SEGMENT_UNIT_SIZE = 32 * 1024 * 1024
+
+class SegmentUnsupported(Exception):
+    """服务器没有按Range返回部分内容，无法分段下载"""
+
+def preallocate_file(file_path, size):
+    """创建指定大小的文件，尽量预先分配磁盘空间以减少碎片"""
+    with open(file_path, 'wb') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            f.truncate(size)
+
+_pwrite_lock = threading.Lock()
+
+def write_at(fd, data, offset):
+    """在文件的指定位置写入数据，多个线程可以同时写同一个文件的不同位置"""
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
     else:
-        return parent_dir + '/' + path_item
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+def load_segment_progress(part_path, validator, size):
+    """读取分段下载进度，返回已完成的分块编号集合；.part不存在或对应的文件版本、大小不同时返回None"""
+    try:
+        with open(part_path + '.segments', 'r', encoding='utf-8') as f:
+            progress = json.load(f)
+        if progress['validator'] == validator and progress['size'] == size and os.path.getsize(part_path) == size:
+            return set(progress['done'])
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_segment_progress(part_path, validator, size, done):
+    """记录已完成的分块，进程中断后可以继续下载其余分块"""
+    progress = {'validator': validator, 'size': size, 'done': sorted(done)}
+    write_file_atomic(part_path + '.segments', json.dumps(progress).encode('utf-8'))
+
+def parse_content_range_start(value):
+    """解析Content-Range: bytes start-end/total中的起始位置，无法解析时返回None"""
+    match = re.match(r'bytes\s+(\d+)-', value or '')
+    return int(match.group(1)) if match else None
 
 def process_strm_content(file_path, replace_ip_with_domain=None):
     """处理STRM文件内容，替换IP为域名"""
@@ -98,26 +353,16 @@ def process_strm_content(file_path, replace_ip_with_domain=None):
         
     try:
         # 读取STRM文件内容
-        with open(file_path, 'r', encoding='utf-8') as f:
+        with open(file_path, 'rb') as f:
             content = f.read()
         
         # 使用正则表达式替换IP地址为域名
-        # 匹配形如 http://192.168.1.1:8080/ 或 http://10.0.0.1/ 的IP地址
-        ip_pattern = r'http://(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(:\d+)?/'
+        new_content = rewrite_strm_bytes(content, replace_ip_with_domain)
         
-        # 检查是否有匹配
-        if re.search(ip_pattern, content):
-            # 替换IP为域名，保留端口号(如果有)
-            new_content = re.sub(ip_pattern, f'http://{replace_ip_with_domain}\\2/', content)
-            
-            # 写回文件
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(new_content)
-                
-            # 只记录文件所在目录，而不是完整路径
-            file_dir = os.path.dirname(file_path)
-            # 日志改为调试级别
-            # logging.debug(f"已处理STRM文件: {os.path.basename(file_path)}")
+        # 检查是否有变化
+        if new_content != content:
+            # 原子写回文件
+            write_file_atomic(file_path, new_content)
             return True
         else:
             logging.debug(f"STRM文件中未找到需要替换的IP: {os.path.basename(file_path)}")
@@ -127,8 +372,965 @@ def process_strm_content(file_path, replace_ip_with_domain=None):
         logging.error(f"处理STRM文件内容时出错: {os.path.basename(file_path)}, {e}")
         return False
 
+def join_remote_path(directory, name):
+    """拼接远程目录和文件名"""
+    return directory.rstrip('/') + '/' + name
+
+def get_directory_id(conn, path, cache):
+    """返回目录在directories表中的id，不存在时连同上级目录一起创建
+
+    :param cache: 路径到id的缓存字典，事务回滚后调用方需要清空
+    """
+    dir_id = cache.get(path)
+    if dir_id is not None:
+        return dir_id
+    parent_id = None
+    if path not in ('/', ''):
+        parent_id = get_directory_id(conn, os.path.dirname(path), cache)
+    conn.execute("INSERT OR IGNORE INTO directories (path, parent_id) VALUES (?, ?)", (path, parent_id))
+    dir_id = conn.execute("SELECT id FROM directories WHERE path = ?", (path,)).fetchone()[0]
+    cache[path] = dir_id
+    return dir_id
+
+def ensure_db_schema(conn):
+    """创建记录数据库的表，并将旧版本的表迁移到当前结构
+
+    文件记录按目录归一化存储：directories保存每个目录一次完整路径及其状态，
+    files只保存(目录id, 文件名)，避免每行重复相同的目录前缀。
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS directories (
+        id INTEGER PRIMARY KEY,
+        parent_id INTEGER,
+        path TEXT NOT NULL UNIQUE,
+        etag TEXT,
+        mtime REAL,
+        child_count INTEGER,
+        check_interval REAL,
+        next_check REAL
+    )''')
+    # 旧版本的目录表没有自适应检查间隔的列
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(directories)")}
+    for column in ('check_interval', 'next_check'):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE directories ADD COLUMN {column} REAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_directories_parent ON directories (parent_id)")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS files (
+        dir_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        etag TEXT,
+        size INTEGER,
+        mtime REAL,
+        PRIMARY KEY (dir_id, name)
+    ) WITHOUT ROWID''')
+    # 本地STRM文件上次替换IP时的修改时间和替换目标，启动时只处理新增、修改过或目标变化的文件
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS strm_rewrites (
+        dir_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        mtime REAL,
+        target TEXT,
+        PRIMARY KEY (dir_id, name)
+    ) WITHOUT ROWID''')
+    # 记录写入代数，每次批量写入加一，用于判断持久化的过滤器是否过期
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS index_meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER
+    )''')
+    conn.execute("INSERT OR IGNORE INTO index_meta (key, value) VALUES ('generation', 0)")
+    # 每次扫描的性能报告，摘要字段单独成列，完整报告保存为JSON
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS scan_reports (
+        id INTEGER PRIMARY KEY,
+        started_at REAL NOT NULL,
+        kind TEXT,
+        duration REAL,
+        downloads INTEGER,
+        errors INTEGER,
+        report TEXT NOT NULL
+    )''')
+    conn.commit()
+    
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'processed_files' in tables or 'directory_state' in tables:
+        migrate_legacy_schema(conn, tables)
+
+def migrate_legacy_schema(conn, tables):
+    """将旧版本的processed_files(path, ...)和directory_state表迁移到归一化结构，完成后删除旧表"""
+    start_time = time.time()
+    logging.info("检测到旧版本的记录数据库，开始迁移到按目录归一化的结构...")
+    cache = {}
+    migrated = 0
+    try:
+        if 'processed_files' in tables:
+            # 最早的版本只有path一列
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(processed_files)")}
+            select = ', '.join(c if c in columns else 'NULL' for c in ('path', 'etag', 'size', 'mtime'))
+            reader = conn.cursor()
+            reader.execute(f"SELECT {select} FROM processed_files")
+            while True:
+                rows = reader.fetchmany(5000)
+                if not rows:
+                    break
+                conn.executemany(
+                    "INSERT OR REPLACE INTO files (dir_id, name, etag, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                    [(get_directory_id(conn, os.path.dirname(path), cache), os.path.basename(path), etag, size, mtime)
+                     for path, etag, size, mtime in rows]
+                )
+                migrated += len(rows)
+        if 'directory_state' in tables:
+            for path, etag, mtime, child_count in conn.execute(
+                    "SELECT path, etag, mtime, child_count FROM directory_state").fetchall():
+                dir_id = get_directory_id(conn, path, cache)
+                conn.execute("UPDATE directories SET etag = ?, mtime = ?, child_count = ? WHERE id = ?",
+                             (etag, mtime, child_count, dir_id))
+        conn.execute("DROP TABLE IF EXISTS processed_files")
+        conn.execute("DROP TABLE IF EXISTS directory_state")
+        conn.execute("UPDATE index_meta SET value = value + 1 WHERE key = 'generation'")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    # 回收旧表占用的磁盘空间
+    conn.execute("VACUUM")
+    logging.info(f"记录数据库迁移完成: {migrated} 个文件记录，{len(cache)} 个目录，耗时 {time.time() - start_time:.2f}秒")
+
+class BloomFilter:
+    """简单的布隆过滤器，判断不存在时一定不存在，判断存在时可能误判"""
+    BITS_PER_ITEM = 10  # 每个元素10位，配合7个哈希函数误判率约1%
+    HASH_COUNT = 7
+    
+    def __init__(self, capacity, bits=None):
+        self.capacity = max(int(capacity), 1024)
+        self.size = self.capacity * self.BITS_PER_ITEM
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+    
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        h2 |= 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.HASH_COUNT)]
+    
+    def add(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self._positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class ProcessedFileIndex:
+    """已处理文件索引：内存中只保留布隆过滤器，命中时再到SQLite中按主键确认
+
+    - 过滤器判断不存在的路径直接视为新文件，不访问数据库
+    - 尚未写入数据库的新记录保存在recent中，写入后由数据库线程调用forget移除
+    - 过滤器连同数据库写入代数一起持久化到.bloom文件，代数一致时启动直接加载，无需重建；
+      数据库线程在批量写入后定期保存，进程被直接终止时过滤器也只落后最后几个批次
+    """
+    FILE_MAGIC = b'WDBLOOM1'
+    
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.filter_path = os.path.splitext(db_path)[0] + '.bloom'
+        self.recent = {}
+        self.recent_lock = threading.Lock()
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        self.count = 0
+        self.filter = self._load_filter()
+    
+    def connection(self):
+        """每个线程使用自己的只读连接"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            self.local.conn = conn
+            with self.connections_lock:
+                self.connections.append(conn)
+        return conn
+    
+    def _generation(self, cursor):
+        row = cursor.execute("SELECT value FROM index_meta WHERE key = 'generation'").fetchone()
+        return row[0] if row else 0
+    
+    def _load_filter(self):
+        """加载持久化的过滤器，过期或不存在时从数据库重建"""
+        start_time = time.time()
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            ensure_db_schema(conn)
+            cursor = conn.cursor()
+            generation = self._generation(cursor)
+            
+            bloom = self._read_filter_file(generation)
+            if bloom is not None:
+                conn.close()
+                logging.info(f"已加载已处理文件过滤器: {self.count} 条记录，耗时 {time.time() - start_time:.2f}秒")
+                return bloom
+            
+            # 按行流式读取文件记录重建过滤器，只有目录路径表完整放入内存
+            self.count = cursor.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+            bloom = BloomFilter(self.count * 2)
+            dir_paths = dict(cursor.execute("SELECT id, path FROM directories").fetchall())
+            for dir_id, name in cursor.execute("SELECT dir_id, name FROM files"):
+                bloom.add(join_remote_path(dir_paths[dir_id], name))
+            conn.close()
+            logging.info(f"已从数据库重建已处理文件过滤器: {self.count} 条记录，耗时 {time.time() - start_time:.2f}秒")
+            self.filter = bloom
+            self.save_filter()
+            return bloom
+        except Exception as e:
+            logging.error(f"加载已处理文件记录失败: {e}")
+            return BloomFilter(0)
+    
+    def _read_filter_file(self, generation):
+        """读取持久化的过滤器，代数不一致或容量不足时返回None"""
+        if not os.path.exists(self.filter_path):
+            return None
+        try:
+            with open(self.filter_path, 'rb') as f:
+                header = f.read(32)
+                magic, file_generation, count, capacity = struct.unpack('<8sQQQ', header)
+                if magic != self.FILE_MAGIC or file_generation != generation or count > capacity:
+                    return None
+                bits = bytearray(f.read())
+            bloom = BloomFilter(capacity, bits)
+            if len(bits) != (bloom.size + 7) // 8:
+                return None
+            self.count = count
+            return bloom
+        except Exception as e:
+            logging.warning(f"读取过滤器文件失败: {e}，将从数据库重建")
+            return None
+    
+    def save_filter(self):
+        """将过滤器和当前数据库写入代数一起保存
+
+        记录先加入过滤器再写入数据库，保存时过滤器包含该代数之前写入的所有记录，
+        可能多出尚未写入的记录，只会多一次数据库确认。
+        """
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            generation = self._generation(conn.cursor())
+            conn.close()
+            tmp_path = self.filter_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(struct.pack('<8sQQQ', self.FILE_MAGIC, generation, self.count, self.filter.capacity))
+                f.write(bytes(self.filter.bits))
+            os.replace(tmp_path, self.filter_path)
+        except Exception as e:
+            logging.warning(f"保存过滤器文件失败: {e}")
+    
+    def get(self, path, default=None):
+        """返回文件的元数据(etag, 大小, 修改时间)，不存在时返回default"""
+        meta = self.recent.get(path)
+        if meta is not None:
+            return meta
+        if path not in self.filter:
+            return default
+        try:
+            row = self.connection().execute(
+                "SELECT f.etag, f.size, f.mtime FROM files f JOIN directories d ON f.dir_id = d.id "
+                "WHERE d.path = ? AND f.name = ?",
+                (os.path.dirname(path), os.path.basename(path))
+            ).fetchone()
+        except Exception as e:
+            logging.warning(f"查询已处理文件记录失败: {path}, {e}")
+            return default
+        return tuple(row) if row is not None else default
+    
+    def __contains__(self, path):
+        return self.get(path) is not None
+    
+    def __setitem__(self, path, meta):
+        with self.recent_lock:
+            if path not in self.recent and path not in self.filter:
+                self.count += 1
+            self.recent[path] = meta
+        self.filter.add(path)
+    
+    def forget(self, batch):
+        """记录已写入数据库后，从recent中移除（期间又被更新的保留）"""
+        with self.recent_lock:
+            for path, meta in batch:
+                if self.recent.get(path) == tuple(meta):
+                    del self.recent[path]
+    
+    def close(self):
+        """关闭所有线程的只读连接并保存过滤器"""
+        with self.connections_lock:
+            for conn in self.connections:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self.connections = []
+        self.save_filter()
+
+# 直方图的默认分桶(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600)
+
+class Metrics:
+    """累计指标，按Prometheus文本格式导出
+
+    计数器和直方图按线程分片记录：每个线程只修改自己的分片，记录时不需要加锁，
+    导出时再汇总所有分片；已结束线程的分片在导出时合并，分片数不会随线程重建增长。
+    已有统计来源的指标(如连接池、队列长度)注册一个函数，导出时调用取当前值。
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []  # [(线程, 分片)]
+        self.retired = {}  # 已结束线程的分片汇总
+        self.definitions = {}  # 名称 -> (类型, 说明, 分桶)
+        self.callbacks = {}  # 名称 -> 返回当前值的函数
+
+    def counter(self, name, help_text, func=None):
+        self.definitions[name] = ('counter', help_text, None)
+        if func is not None:
+            self.callbacks[name] = func
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.definitions[name] = ('histogram', help_text, tuple(buckets))
+
+    def gauge(self, name, help_text, func=None):
+        """func返回数值，或{标签元组: 数值}；没有func时由add()分片累加"""
+        self.definitions[name] = ('gauge', help_text, None)
+        if func is not None:
+            self.callbacks[name] = func
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = {}
+            self.local.shard = shard
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def add(self, name, value=1, labels=()):
+        """计数器或分片仪表盘加value，labels为((标签名, 值), ...)"""
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """记录一次直方图观测值"""
+        shard = self._shard()
+        key = (name, labels)
+        data = shard.get(key)
+        if data is None:
+            # [各分桶计数..., 总和, 次数]
+            data = shard[key] = [0] * (len(self.definitions[name][2]) + 2)
+        index = bisect.bisect_left(self.definitions[name][2], value)
+        if index < len(data) - 2:
+            data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    @staticmethod
+    def _merge(target, shard):
+        for key, value in list(shard.items()):
+            if isinstance(value, list):
+                current = target.get(key)
+                target[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+            else:
+                target[key] = target.get(key, 0) + value
+
+    def collect(self):
+        """汇总所有分片，返回{(名称, 标签): 值}"""
+        with self.lock:
+            alive = []
+            for thread, shard in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self.retired, shard)
+            self.shards = alive
+            totals = {}
+            self._merge(totals, self.retired)
+        for _, shard in alive:
+            self._merge(totals, shard)
+        return totals
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+    def render(self):
+        """导出Prometheus文本格式"""
+        totals = self.collect()
+        by_name = {}
+        for (name, labels), value in totals.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name, func in self.callbacks.items():
+            try:
+                value = func()
+            except Exception:
+                continue
+            if isinstance(value, dict):
+                by_name[name] = list(value.items())
+            elif value is not None:
+                by_name[name] = [((), value)]
+
+        lines = []
+        for name, (kind, help_text, buckets) in self.definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            samples = by_name.get(name) or ([((), 0)] if kind == 'counter' else [])
+            # 标签值可能混有数字和字符串，按字符串排序
+            for labels, value in sorted(samples, key=lambda item: [(k, str(v)) for k, v in item[0]]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._format_labels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {value[-1]}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+
+# 持续写入数据库时保存已处理文件过滤器的最小间隔(秒)
+FILTER_SAVE_INTERVAL = 60
+
+# 扫描报告中保留的最慢目录和文件数，以及数据库中保留的报告数
+SCAN_REPORT_TOP = 10
+SCAN_REPORTS_LIMIT = 2000
+
+class ScanProfile:
+    """一次扫描的性能记录
+
+    分别累计列出目录(list)、下载文件(download)和下载后处理(post：STRM替换、保存记录、提交下载后命令)
+    的耗时，多个线程并行时为各线程耗时之和；同时保留最慢的目录和文件、重试次数。
+    每个目录和文件记录一次，不在单个请求或数据块的路径上。
+    """
+    
+    PHASES = ('list', 'download', 'post')
+    
+    def __init__(self, kind, roots, top=SCAN_REPORT_TOP):
+        self.kind = kind
+        self.roots = list(roots)
+        self.top = top
+        self.started_at = time.time()
+        self.lock = threading.Lock()
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.counts = dict.fromkeys(self.PHASES, 0)
+        self.retries = {'list': 0, 'download': 0}
+        self.slowest = {'list': [], 'download': []}  # 最小堆[(耗时, 路径, 条目数或大小)]
+    
+    def record(self, phase, path, seconds, detail=None):
+        """记录一个目录或文件在某阶段的耗时，detail为目录的条目数或文件大小"""
+        with self.lock:
+            self.seconds[phase] += seconds
+            self.counts[phase] += 1
+            heap = self.slowest.get(phase)
+            if heap is None:
+                return
+            item = (seconds, path, detail)
+            if len(heap) < self.top:
+                heapq.heappush(heap, item)
+            elif seconds > heap[0][0]:
+                heapq.heapreplace(heap, item)
+    
+    def retry(self, phase):
+        with self.lock:
+            self.retries[phase] += 1
+    
+    def report(self, duration, requests, received_bytes, **counts):
+        """生成可保存为JSON的报告"""
+        with self.lock:
+            phases = {phase: {'seconds': round(self.seconds[phase], 3), 'count': self.counts[phase]}
+                      for phase in self.PHASES}
+            slowest_dirs = sorted(self.slowest['list'], key=lambda item: item[0], reverse=True)
+            slowest_files = sorted(self.slowest['download'], key=lambda item: item[0], reverse=True)
+            retries = dict(self.retries)
+        return dict({
+            'started_at': datetime.fromtimestamp(self.started_at).strftime('%Y-%m-%d %H:%M:%S'),
+            'kind': self.kind,
+            'roots': self.roots,
+            'duration': round(duration, 3),
+            'phases': phases,
+            'retries': retries,
+            'requests': requests,
+            'requests_per_second': round(requests / duration, 2) if duration > 0 else None,
+            'received_bytes': received_bytes,
+            'slowest_dirs': [{'path': path, 'seconds': round(seconds, 3), 'entries': entries}
+                             for seconds, path, entries in slowest_dirs],
+            'slowest_files': [{'path': path, 'seconds': round(seconds, 3), 'size': size}
+                              for seconds, path, size in slowest_files],
+        }, **counts)
+
+def load_scan_reports(db_path, limit=50, before=None):
+    """读取最近的扫描报告摘要(不含最慢目录和文件列表)，按时间从新到旧
+
+    :param before: 只返回id小于该值的报告，用于分页
+    """
+    if not os.path.exists(db_path):
+        return []
+    conn = sqlite3.connect(db_path, timeout=60)
+    try:
+        rows = conn.execute(
+            "SELECT id, report FROM scan_reports WHERE id < ? ORDER BY id DESC LIMIT ?",
+            (before if before is not None else sys.maxsize, limit)).fetchall()
+    except sqlite3.OperationalError:
+        # 旧版本创建的数据库在监控启动前还没有scan_reports表
+        return []
+    finally:
+        conn.close()
+    reports = []
+    for scan_id, data in rows:
+        report = json.loads(data)
+        report.pop('slowest_dirs', None)
+        report.pop('slowest_files', None)
+        reports.append(dict(report, id=scan_id))
+    return reports
+
+def load_scan_report(db_path, scan_id):
+    """读取一次扫描的完整报告，不存在时返回None"""
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path, timeout=60)
+    try:
+        row = conn.execute("SELECT report FROM scan_reports WHERE id = ?", (scan_id,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+    return dict(json.loads(row[0]), id=scan_id) if row else None
+
+class PostCommandRunner:
+    """在独立的有界线程池中执行下载后命令，不占用下载线程
+
+    - 单文件模式：每个文件执行一次命令，{local_path}替换为文件路径
+    - 批量模式(命令包含{local_paths}或batch_size大于0)：累积的文件达到batch_size个或等待超过
+      batch_window秒时执行一次命令，{local_paths}替换为所有文件路径，没有该占位符时每行一个路径写入标准输入
+    - 等待执行的命令数达到上限时，提交方阻塞等待，避免积压无限增长
+    - 记录执行次数、失败次数、耗时和最近的执行结果(退出码、文件数、耗时)
+    """
+
+    def __init__(self, command, workers=2, batch_size=0, batch_window=5, metrics=None):
+        """命令中引号不匹配时shlex.split抛出ValueError；线程池和定时执行线程由start()启动"""
+        self.command = command
+        self.metrics = metrics
+        self.args = shlex.split(command)
+        self.use_placeholder = any('{local_paths}' in arg for arg in self.args)
+        self.batch_size = batch_size or (100 if self.use_placeholder else 0)
+        self.batch_window = batch_window
+        self.workers = max(1, workers)
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(self.workers * 4)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_since = 0
+        self.closed = threading.Event()
+        self.stats = {'runs': 0, 'failures': 0, 'files': 0, 'total_seconds': 0.0}
+        self.recent = deque(maxlen=20)
+        self.flusher = None
+    
+    def start(self):
+        """启动执行命令的线程池，批量模式下同时启动定时执行批次的线程"""
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='post-command')
+        if self.batch_size:
+            self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self.flusher.start()
+
+    def submit(self, local_path):
+        """提交一个下载完成的文件"""
+        if not self.batch_size:
+            self._run([local_path])
+            return
+        with self.lock:
+            if not self.pending:
+                self.pending_since = time.time()
+            self.pending.append(local_path)
+            if len(self.pending) < self.batch_size:
+                return
+            batch = self.pending
+            self.pending = []
+        self._run(batch)
+
+    def flush(self):
+        """立即执行累积的批次"""
+        with self.lock:
+            batch = self.pending
+            self.pending = []
+        if batch:
+            self._run(batch)
+
+    def _flush_loop(self):
+        """定期检查累积的批次，等待超过batch_window秒时执行"""
+        interval = max(0.5, min(self.batch_window / 2, 5))
+        while not self.closed.wait(interval):
+            with self.lock:
+                expired = self.pending and time.time() - self.pending_since >= self.batch_window
+            if expired:
+                self.flush()
+
+    def _run(self, paths):
+        """占用一个名额后交给线程池执行，名额在命令结束后释放"""
+        self.slots.acquire()
+        try:
+            if self.executor is None:
+                raise RuntimeError("线程池未启动")
+            self.executor.submit(self._execute, paths)
+        except RuntimeError:
+            # 线程池未启动或已关闭(停止过程中)，直接在当前线程执行
+            self.slots.release()
+            self._execute(paths, release=False)
+
+    def _build(self, paths):
+        """生成命令参数和标准输入内容"""
+        args = []
+        for arg in self.args:
+            if arg == '{local_paths}':
+                args.extend(paths)
+            else:
+                args.append(arg.replace('{local_paths}', ' '.join(paths)).replace('{local_path}', paths[0]))
+        stdin = None
+        if self.batch_size and not self.use_placeholder:
+            stdin = ''.join(path + '\n' for path in paths)
+        return args, stdin
+
+    def _execute(self, paths, release=True):
+        start_time = time.time()
+        returncode = None
+        try:
+            args, stdin = self._build(paths)
+            logging.debug(f"执行下载后命令: {len(paths)} 个文件")
+            process = subprocess.Popen(
+                args,
+                stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True
+            )
+            stdout, stderr = process.communicate(stdin)
+            returncode = process.returncode
+            if returncode == 0:
+                logging.debug(f"命令执行成功，耗时 {time.time() - start_time:.2f}秒")
+            else:
+                logging.error(f"下载后命令执行失败，退出码 {returncode}: {stderr.strip()[:200]}")
+        except Exception as e:
+            logging.error(f"执行下载后命令时出错: {e}")
+        finally:
+            duration = time.time() - start_time
+            with self.lock:
+                self.stats['runs'] += 1
+                self.stats['files'] += len(paths)
+                self.stats['total_seconds'] += duration
+                if returncode != 0:
+                    self.stats['failures'] += 1
+                self.recent.append({
+                    'time': datetime.fromtimestamp(start_time).strftime('%Y-%m-%d %H:%M:%S'),
+                    'files': len(paths),
+                    'returncode': returncode,
+                    'seconds': round(duration, 3),
+                })
+            if self.metrics:
+                self.metrics.observe('webdav_post_command_seconds', duration)
+            if release:
+                self.slots.release()
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.stats)
+            data['recent'] = list(self.recent)
+            data['pending'] = len(self.pending)
+        data['total_seconds'] = round(data['total_seconds'], 3)
+        data['batch_size'] = self.batch_size
+        return data
+
+    def close(self):
+        """执行剩余的批次并等待所有命令结束"""
+        self.closed.set()
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+class PoolStats:
+    """连接池指标：建立的连接数、等待空闲连接的次数和耗时、回收的空闲连接数"""
+    
+    FIELDS = ('connects', 'pool_waits', 'pool_wait_seconds', 'idle_reaped')
+    
+    def __init__(self, pool_maxsize):
+        self.pool_maxsize = pool_maxsize
+        self.lock = threading.Lock()
+        self.values = dict.fromkeys(self.FIELDS, 0)
+    
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] += value
+    
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.values)
+        data['pool_wait_seconds'] = round(data['pool_wait_seconds'], 3)
+        data['pool_maxsize'] = self.pool_maxsize
+        return data
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """所有列表和下载线程共享的连接池
+
+    连接数上限按并发数确定，池中连接都在使用时等待空闲连接(pool_block)，不会新建后再丢弃；
+    等待超过pool_timeout秒时抛出异常，连接意外未归还时请求失败而不是永远阻塞；
+    空闲超过idle_timeout的连接在复用前或由reap_idle()关闭，避免使用已被服务器断开的长连接。
+    """
+    
+    def __init__(self, stats, pool_connections, pool_maxsize, idle_timeout=60, pool_timeout=60):
+        self.stats = stats
+        self.idle_timeout = idle_timeout
+        self.pool_timeout = pool_timeout
+        super().__init__(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+    
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': self._pool_class(HTTPConnectionPool),
+            'https': self._pool_class(HTTPSConnectionPool),
+        }
+    
+    def _pool_class(self, base):
+        """生成带统计和空闲回收的urllib3连接池类"""
+        adapter = self
+        
+        class Connection(base.ConnectionCls):
+            def connect(self):
+                adapter.stats.add('connects')
+                super().connect()
+        
+        class Pool(base):
+            ConnectionCls = Connection
+            
+            def _get_conn(self, timeout=None):
+                waiting = self.pool is not None and self.pool.empty()
+                start = time.monotonic()
+                conn = super()._get_conn(timeout if timeout is not None else adapter.pool_timeout)
+                if waiting:
+                    adapter.stats.add('pool_waits')
+                    adapter.stats.add('pool_wait_seconds', time.monotonic() - start)
+                adapter._reap(conn, time.monotonic())
+                return conn
+            
+            def _put_conn(self, conn):
+                if conn is not None:
+                    conn.last_used = time.monotonic()
+                super()._put_conn(conn)
+        
+        return Pool
+    
+    def _reap(self, conn, now):
+        """关闭空闲过久的连接，下次使用时自动重新连接"""
+        last_used = getattr(conn, 'last_used', None)
+        if last_used is not None and conn.sock is not None and now - last_used > self.idle_timeout:
+            conn.close()
+            self.stats.add('idle_reaped')
+    
+    def reap_idle(self):
+        """关闭池中所有空闲过久的连接"""
+        now = time.monotonic()
+        for key in self.poolmanager.pools.keys():
+            pool = self.poolmanager.pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            with pool.pool.mutex:
+                for conn in pool.pool.queue:
+                    if conn is not None:
+                        self._reap(conn, now)
+
+def parse_size(value):
+    """解析带单位的大小(如 10M、512K、1.5G)，返回字节数；空值或0表示不限制"""
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    text = str(value).strip().upper().rstrip('B').rstrip('I')
+    if not text:
+        return 0
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(float(text))
+
+class TokenBucket:
+    """令牌桶限速器，同一个监控器的所有线程和协程共享
+
+    取令牌时先预约(余额可以为负)，再在锁外等待，等待的请求按到达顺序依次放行。
+    rate<=0表示不限制。
+    """
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0  # 累计等待秒数
+        self.lock = threading.Lock()
+    
+    def _reserve(self, amount):
+        """预约amount个令牌，返回需要等待的秒数"""
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.waited += wait
+            return wait
+    
+    def acquire(self, amount=1):
+        wait = self._reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+    
+    async def acquire_async(self, amount=1):
+        wait = self._reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
+    
+    def snapshot(self):
+        with self.lock:
+            return {'rate': self.rate, 'waited_seconds': round(self.waited, 3)}
+
+# 表示服务器过载或限流的状态码，出现时并发控制器会降低并发数
+OVERLOAD_STATUS = {429, 502, 503, 504}
+
+# _dav_request的操作对应的HTTP方法，用于指标标签
+REQUEST_METHODS = {'list': 'PROPFIND', 'download': 'GET'}
+
+class AdaptiveConcurrency:
+    """AIMD并发控制器，限制同时进行的WebDAV请求数
+
+    请求正常且延迟没有明显升高时并发上限缓慢加一(每轮约加1)，出现限流、服务器错误、
+    网络错误或延迟超过基线的latency_tolerance倍时减半；响应带Retry-After时暂停发送新请求。
+    延迟平均值和基线按操作(list/download)分别计算：列出大目录本来就比下载STRM小文件慢，
+    不能互相比较。基线是长期平均，大小目录混合的稳定延迟不算变慢；只有同一操作之前的
+    短期平均延迟和本次延迟都超过基线的latency_tolerance倍时才视为拥塞，单个慢请求不会触发减半。
+    线程使用acquire()/release()，asyncio引擎在事件循环中使用acquire_async()/release_async()。
+    """
+    
+    def __init__(self, min_limit, max_limit, latency_tolerance=2.0):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.limit = float(self.max_limit)
+        self.inflight = 0
+        self.latency = {}  # 操作 -> 请求延迟(到收到响应头)的指数滑动平均
+        self.baseline = {}  # 操作 -> 延迟基线，变化缓慢的长期滑动平均
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.decreases = 0
+        self.throttled = 0
+        self.cond = threading.Condition()
+        self.async_cond = None
+    
+    def _try_acquire(self):
+        """有空闲名额且未暂停时占用一个名额，否则返回需要等待的秒数(None表示等待名额释放)"""
+        wait = self.paused_until - time.monotonic()
+        if wait > 0:
+            return wait
+        if self.inflight < int(self.limit):
+            self.inflight += 1
+            return 0
+        return None
+    
+    def acquire(self):
+        with self.cond:
+            while True:
+                wait = self._try_acquire()
+                if wait == 0:
+                    return
+                self.cond.wait(wait)
+    
+    def release(self, latency=None, overloaded=False, retry_after=None, operation='download'):
+        with self.cond:
+            self._record(latency, overloaded, retry_after, operation)
+            self.cond.notify_all()
+    
+    async def acquire_async(self):
+        if self.async_cond is None:
+            self.async_cond = asyncio.Condition()
+        async with self.async_cond:
+            while True:
+                with self.cond:
+                    wait = self._try_acquire()
+                if wait == 0:
+                    return
+                try:
+                    await asyncio.wait_for(self.async_cond.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def release_async(self, latency=None, overloaded=False, retry_after=None, operation='download'):
+        with self.cond:
+            self._record(latency, overloaded, retry_after, operation)
+        async with self.async_cond:
+            self.async_cond.notify_all()
+    
+    def _record(self, latency, overloaded, retry_after, operation):
+        """释放名额并根据本次请求的结果调整并发上限，调用方持有锁"""
+        self.inflight -= 1
+        now = time.monotonic()
+        previous = average = self.latency.get(operation)
+        baseline = self.baseline.get(operation)
+        if latency is not None and not overloaded:
+            average = latency if average is None else average * 0.8 + latency * 0.2
+            baseline = latency if baseline is None else baseline + (latency - baseline) * 0.02
+            self.latency[operation] = average
+            self.baseline[operation] = baseline
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        
+        # 本次延迟和之前的平均延迟都超过基线才算变慢：单个大目录的慢请求不会拉低并发
+        threshold = baseline * self.latency_tolerance if baseline else None
+        slow = (latency is not None and threshold is not None and previous is not None
+                and latency > threshold and previous > threshold)
+        if overloaded or retry_after or slow:
+            if overloaded or retry_after:
+                self.throttled += 1
+            # 同一波拥塞只减半一次
+            if now - self.last_decrease >= max(1.0, average or 0):
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.last_decrease = now
+                self.decreases += 1
+                # 延迟基线随之重置为当前值，避免持续按旧基线判断为变慢
+                if slow:
+                    self.baseline[operation] = average
+        elif latency is not None:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+    
+    def snapshot(self):
+        with self.cond:
+            return {
+                'limit': int(self.limit),
+                'inflight': self.inflight,
+                'min_limit': self.min_limit,
+                'max_limit': self.max_limit,
+                'latency_ms': {op: round(value * 1000, 1) for op, value in self.latency.items()},
+                'baseline_ms': {op: round(value * 1000, 1) for op, value in self.baseline.items()},
+                'paused_seconds': round(max(0.0, self.paused_until - time.monotonic()), 1),
+                'decreases': self.decreases,
+                'throttled': self.throttled,
+            }
+
 class WebdavMonitor:
-    def __init__(self, webdav_url, username, password, local_dir, remote_dir='/', check_interval=300, max_workers=5, post_download_command=None, replace_ip=None, pool_connections=20, pool_maxsize=30):
+    def __init__(self, webdav_url, username, password, local_dir, remote_dir='/', check_interval=300, max_workers=5, post_download_command=None, replace_ip=None, pool_connections=20, pool_maxsize=None, list_workers=4, full_scan_interval=6, max_dir_interval=86400, depth_infinity=False, db_batch_size=200, db_flush_interval=10, strm_workers=4, min_concurrency=2, max_concurrency=None, max_rps=0, max_propfind_rps=0, max_get_rps=0, max_bandwidth=0, segment_threshold='64M', max_segments=8, segments_per_file=4, bootstrap_index='auto', bootstrap_reconcile=True, post_command_workers=2, post_command_batch_size=0, post_command_batch_window=5, hot_paths=None):
         """
         初始化WebDAV监控器
         
@@ -139,19 +1341,63 @@ class WebdavMonitor:
         :param remote_dir: 远程扫描目录，默认为根目录
         :param check_interval: 检查间隔(秒)，默认5分钟
         :param max_workers: 最大并行下载线程数
-        :param post_download_command: 下载完成后执行的命令，可包含{local_path}占位符
+        :param post_download_command: 下载完成后执行的命令，可包含{local_path}占位符；批量模式可使用{local_paths}占位符，或从标准输入读取路径列表
         :param replace_ip: 下载后替换STRM文件中的IP为指定域名
-        :param pool_connections: 连接池初始连接数
-        :param pool_maxsize: 连接池最大连接数
+        :param pool_connections: 缓存的主机连接池数
+        :param pool_maxsize: 每个主机的最大连接数，默认为列表线程数+下载线程数+最大分段连接数+2
+        :param list_workers: 并行列出目录的线程数
+        :param full_scan_interval: 每隔多少次扫描强制进行一次完整扫描，其余扫描跳过未变化的目录；小于等于1表示每次都完整扫描
+        :param max_dir_interval: 目录最长检查间隔(秒)；没有变化的目录检查间隔从check_interval起逐次加倍，直到该上限
+        :param depth_infinity: 使用一次Depth:infinity PROPFIND获取整棵目录树，服务器拒绝时自动回退到逐目录列出
+        :param db_batch_size: 数据库批量写入的记录数
+        :param db_flush_interval: 数据库自动刷新间隔(秒)
+        :param strm_workers: 启动时后台处理已下载STRM文件的线程数
+        :param min_concurrency: 自适应并发控制的最小并发请求数
+        :param max_concurrency: 自适应并发控制的最大并发请求数，默认为列表线程数+下载线程数
+        :param max_rps: 每秒最多发送的请求总数，0表示不限制
+        :param max_propfind_rps: 每秒最多发送的PROPFIND(列出目录)请求数，0表示不限制
+        :param max_get_rps: 每秒最多发送的GET(下载)请求数，0表示不限制
+        :param max_bandwidth: 下载带宽上限(字节/秒，可带K/M/G单位)，0表示不限制
+        :param segment_threshold: 大于该大小(可带K/M/G单位)的文件分段并行下载；文件按32M为单位分段，小于32M的设置按32M计算
+        :param max_segments: 所有文件同时进行的分段连接总数，小于2表示不分段下载
+        :param segments_per_file: 单个文件最多同时下载的分段数
+        :param bootstrap_index: 从本地已有文件重建已处理文件索引：auto(索引为空时)、force(每次启动时)或off
+        :param bootstrap_reconcile: 重建的记录保存本地文件大小，首次扫描时与远程列表比较，不一致的文件重新下载
+        :param post_command_workers: 同时执行的下载后命令数
+        :param post_command_batch_size: 大于0时批量执行下载后命令，每批最多的文件数(命令包含{local_paths}时默认100)
+        :param post_command_batch_window: 批量模式下文件最多等待的秒数，超过后即使不满一批也执行
+        :param hot_paths: 优先扫描的远程路径列表(或逗号分隔的字符串)，其余目录按修改时间从新到旧扫描
         """
         self.local_dir = local_dir
         self.remote_dir = remote_dir
         self.check_interval = check_interval
         self.max_workers = max_workers
         self.post_download_command = post_download_command
+        # 累计运行指标，通过/metrics导出
+        self.metrics = Metrics()
+        # 下载后命令在独立的线程池中执行，不占用下载线程
+        self.post_commands = None
+        if post_download_command:
+            try:
+                self.post_commands = PostCommandRunner(post_download_command, post_command_workers,
+                                                       post_command_batch_size, post_command_batch_window,
+                                                       self.metrics)
+            except ValueError as e:
+                logging.error(f"下载后命令格式错误，已禁用: {e}")
         self.replace_ip = replace_ip
         self.pool_connections = pool_connections
-        self.pool_maxsize = pool_maxsize
+        self.list_workers = list_workers
+        self.full_scan_interval = full_scan_interval
+        self.max_dir_interval = max(max_dir_interval, check_interval)
+        self.depth_infinity = depth_infinity
+        self.infinity_supported = True  # 服务器拒绝Depth:infinity后置为False
+        if isinstance(hot_paths, str):
+            hot_paths = hot_paths.split(',')
+        self.hot_paths = ['/' + p.strip().strip('/') for p in hot_paths or [] if p.strip()]
+        self.strm_workers = strm_workers
+        self.strm_thread = None  # 启动时处理已下载STRM文件的后台线程
+        self.bootstrap_index = bootstrap_index
+        self.bootstrap_reconcile = bootstrap_reconcile
         
         # 确保本地目录存在
         if not os.path.exists(local_dir):
@@ -165,10 +1411,32 @@ class WebdavMonitor:
             'disable_check': True,
             'webdav_timeout': 30,  # 设置较长的超时时间
             'verbose': logging.getLogger().level <= logging.DEBUG,  # 根据日志级别自动设置WebDAV的verbose
-            'pool_connections': self.pool_connections,  # 连接池初始连接数
-            'pool_maxsize': self.pool_maxsize      # 连接池最大连接数
         }
         
+        # 所有线程共享一个连接池，大小按并发数确定(另留给目录检查和Depth:infinity流的连接)，跨扫描保持长连接
+        self.pool_maxsize = pool_maxsize or (max(1, list_workers) + max_workers + max(0, max_segments) + 2)
+        self.pool_stats = PoolStats(self.pool_maxsize)
+        self.transport = PooledHTTPAdapter(self.pool_stats, self.pool_connections, self.pool_maxsize)
+        self.reaper_thread = None
+        
+        # 根据延迟、错误率和Retry-After自适应调整同时进行的请求数
+        self.concurrency = AdaptiveConcurrency(min_concurrency, max_concurrency or self._request_capacity())
+        self.request_local = threading.local()  # 响应钩子记录的最近一次响应状态，按线程保存
+        
+        # 所有线程共享的请求速率和带宽限制：请求同时计入总预算和对应操作的预算
+        self.request_bucket = TokenBucket(max_rps)
+        self.operation_buckets = {'list': TokenBucket(max_propfind_rps), 'download': TokenBucket(max_get_rps)}
+        self.bandwidth_bucket = TokenBucket(parse_size(max_bandwidth))
+        
+        # 大文件分段下载：分段连接总数全局受限，单个文件按空闲名额和当前并发上限决定分段数
+        self.segment_threshold = parse_size(segment_threshold)
+        self.max_segments = max_segments
+        self.segments_per_file = segments_per_file
+        self.segment_slots = threading.BoundedSemaphore(max(1, max_segments))
+        # 所有下载线程共用的分段线程池，线程在第一次提交分段时才创建
+        self.segment_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, max_segments), thread_name_prefix='segment')
+        
         # 确保域名解析工作正常
         try:
             import socket
@@ -185,35 +1453,63 @@ class WebdavMonitor:
         
         # 使用SQLite数据库记录已处理的文件
         self.file_tracker = os.path.join(local_dir, '.processed_files.db')
+        self._check_index_db()
         self.processed_files = self._load_processed_files()
         
+        # 目录状态记录(etag/修改时间/子条目数)，用于增量扫描时跳过未变化的子树
+        self.dir_state = self._load_dir_state()
+        self.full_scan = True
+        
         # 上次扫描时间记录
         self.last_scan_file = os.path.join(local_dir, '.last_scan_time')
         self.last_scan_time = self._load_last_scan_time()
         
-        # 下载队列和线程池
-        self.download_queue = queue.Queue()
+        # 有上限的下载队列：新文件很多时列表线程等待下载线程，内存占用保持平稳
+        self.download_queue = queue.Queue(maxsize=max(1, max_workers) * 10)
         self.stop_flag = threading.Event()
         
+        # 扫描调度：等待下次定时扫描时可被stop()或request_scan()立即唤醒
+        self.scan_condition = threading.Condition()
+        self.scan_full_requested = False  # 等待执行的完整扫描请求
+        self.scan_paths = set()  # 等待执行的子目录扫描请求
+        
         # 下载统计
         self.download_count = 0
         self.error_count = 0
         self.processed_count = 0
+        self.skipped_dirs = 0  # 增量扫描跳过的未变化目录数
+        self.not_modified_count = 0  # 条件请求返回304的文件数
         self.dir_stats = {}  # 按目录统计下载和处理的文件
         self.stats_lock = threading.Lock()
+        self._register_metrics()
         
         # 数据库操作队列和批处理
         self.db_queue = queue.Queue()
-        self.db_batch_size = 50  # 批量处理大小
+        self.db_batch_size = db_batch_size  # 批量处理大小
         self.pending_files = []  # 待处理的文件路径列表
+        self.pending_dirs = []  # 待写入的目录状态列表
+        self.pending_strm = []  # 待写入的STRM替换记录列表
         self.db_batch_lock = threading.Lock()
         self.db_last_flush_time = time.time()
-        self.db_flush_interval = 30  # 30秒自动刷新一次
+        self.db_flush_interval = db_flush_interval  # 自动刷新间隔(秒)
+        self.db_conn = None  # 数据库工作线程持有的写连接
+        self.db_dir_ids = {}  # 写连接使用的目录路径到id的缓存
+        self.db_spill_file = self.file_tracker + '.spill'  # 写入失败批次的暂存文件
+        self.db_writes = 0  # 成功写入数据库的批次数
+        self.filter_saved_writes = 0  # 上次保存过滤器时已写入的批次数
+        self.filter_saved_at = time.time()
+        
+        # 数据库工作线程重建索引(如果需要)后设置，监控循环等待它再开始首次扫描
+        self.index_ready = threading.Event()
         
         # 启动数据库工作线程
         self.db_worker_thread = threading.Thread(target=self._db_worker, daemon=True)
         self.db_worker_thread.start()
         logging.info("数据库工作线程已启动，批处理大小: %d, 自动刷新间隔: %d秒", self.db_batch_size, self.db_flush_interval)
+        
+        # 监控器构建完成后再启动下载后命令的线程，构造失败时不会遗留线程
+        if self.post_commands is not None:
+            self.post_commands.start()
     
     def _create_client_with_retry(self, max_retries=3):
         """创建WebDAV客户端并尝试连接，失败时重试"""
@@ -222,7 +1518,7 @@ class WebdavMonitor:
         
         while retry_count < max_retries:
             try:
-                client = wc.Client(self.client_options)
+                client = self._new_client()
                 # 测试连接
                 logging.info(f"测试WebDAV连接 (尝试 {retry_count+1}/{max_retries})...")
                 client.check(self.remote_dir)
@@ -237,46 +1533,254 @@ class WebdavMonitor:
         # 如果所有重试都失败
         logging.error(f"无法连接到WebDAV服务器，最后错误: {last_error}")
         # 返回客户端，即使未通过测试
-        return wc.Client(self.client_options)
+        return self._new_client()
+    
+    def _new_client(self):
+        """创建WebDAV客户端，使用共享的连接池"""
+        client = wc.Client(self.client_options)
+        client.session.mount('http://', self.transport)
+        client.session.mount('https://', self.transport)
+        client.session.hooks['response'].append(self._on_response)
+        return client
+    
+    def _on_response(self, response, *args, **kwargs):
+        """记录响应状态和Retry-After，webdav3对错误状态抛出的异常中不包含响应头
+
+        同时保存响应对象：webdav3对404/405/423/507直接抛出异常，不读取也不关闭流式响应，
+        需要由调用方关闭，否则连接不会归还连接池。
+        """
+        self.request_local.response = response
+        self.request_local.status = response.status_code
+        self.request_local.retry_after = parse_retry_after(response.headers.get('Retry-After'))
+    
+    def _close_error_response(self):
+        """关闭webdav3抛出异常时未关闭的响应，把连接归还连接池"""
+        response = getattr(self.request_local, 'response', None)
+        self.request_local.response = None
+        if response is not None:
+            release_response(response)
+    
+    def _request_capacity(self):
+        """执行请求的线程总数，即自适应并发上限的默认值"""
+        return max(1, self.list_workers) + self.max_workers
+    
+    def rate_limits(self):
+        """返回各限速器的速率和累计等待时间"""
+        return {
+            'requests': self.request_bucket.snapshot(),
+            'propfind': self.operation_buckets['list'].snapshot(),
+            'get': self.operation_buckets['download'].snapshot(),
+            'bandwidth': self.bandwidth_bucket.snapshot(),
+        }
+    
+    def _register_metrics(self):
+        """注册导出的指标，仪表盘在导出时读取当前值"""
+        m = self.metrics
+        m.histogram('webdav_request_seconds', 'WebDAV请求延迟(收到响应头为止)，按方法区分')
+        m.counter('webdav_requests_total', 'WebDAV请求数，按方法和状态码区分')
+        m.counter('webdav_received_bytes_total', '从WebDAV服务器接收的字节数')
+        m.histogram('webdav_db_flush_seconds', '批量写入数据库的耗时')
+        m.histogram('webdav_post_command_seconds', '下载后命令的执行耗时', DURATION_BUCKETS)
+        m.histogram('webdav_scan_seconds', '扫描耗时，按扫描类型区分', DURATION_BUCKETS)
+        m.counter('webdav_downloaded_files_total', '下载的新文件和已变化文件数')
+        m.counter('webdav_not_modified_files_total', '检查后确认未修改的文件数')
+        m.counter('webdav_download_errors_total', '下载失败的文件数')
+        m.counter('webdav_strm_processed_total', '替换过IP的STRM文件数')
+        m.counter('webdav_skipped_dirs_total', '增量扫描跳过的未变化目录数')
+        m.gauge('webdav_active_workers', '正在列出目录或下载文件的工作线程(协程)数')
+        m.gauge('webdav_download_queue_depth', '下载队列中等待的文件数', self._download_queue_depth)
+        m.gauge('webdav_concurrency_limit', '自适应并发控制器的当前并发上限',
+                lambda: self.concurrency.snapshot().get('limit'))
+        m.counter('webdav_pool_connects_total', '建立的连接数', lambda: self.pool_metrics()['connects'])
+        m.counter('webdav_pool_wait_seconds_total', '等待空闲连接的总耗时',
+                  lambda: self.pool_metrics()['pool_wait_seconds'])
+        m.gauge('webdav_processed_files', '已处理文件索引中的记录数(近似值)', lambda: self.processed_files.count)
+    
+    def _download_queue_depth(self):
+        return self.download_queue.qsize()
+    
+    def _received(self, size):
+        """计入带宽限制和接收字节数"""
+        self.bandwidth_bucket.acquire(size)
+        self.metrics.add('webdav_received_bytes_total', size)
+    
+    def _read_body(self, response):
+        """读取完整响应体，计入带宽限制"""
+        content = response.content
+        self._received(len(content))
+        return content
+    
+    @contextlib.contextmanager
+    def _dav_request(self, action, path, data=None, headers_ext=None, streaming=False):
+        """经过限速器和并发控制器发送WebDAV请求，with块结束时关闭响应并把结果反馈给控制器
+
+        :param streaming: 收到响应头后立即归还并发名额。Depth:infinity的响应流在整个扫描期间
+            一直在读，读取方还会阻塞在有界的下载队列上，占着名额时并发上限降到1就会与下载线程互相等待
+        """
+        # 超出速率预算时在占用并发名额之前等待
+        self.request_bucket.acquire()
+        self.operation_buckets[action].acquire()
+        self.concurrency.acquire()
+        self.request_local.response = None
+        self.request_local.status = None
+        self.request_local.retry_after = None
+        start = time.monotonic()
+        response = None
+        elapsed = None
+        latency = None
+        overloaded = False
+        released = False
+        try:
+            try:
+                response = self.client.execute_request(action, path, data=data, headers_ext=headers_ext)
+            except Exception:
+                # 没有收到响应(连接失败、超时)或服务器返回限流/过载状态码
+                self._close_error_response()
+                status = self.request_local.status
+                overloaded = status is None or status in OVERLOAD_STATUS
+                elapsed = time.monotonic() - start
+                if not overloaded:
+                    latency = elapsed
+                raise
+            latency = elapsed = time.monotonic() - start
+            if streaming:
+                released = True
+                self.concurrency.release(latency, overloaded, self.request_local.retry_after, action)
+            yield response
+        finally:
+            if response is not None:
+                release_response(response)
+            if not released:
+                self.concurrency.release(latency, overloaded, self.request_local.retry_after, action)
+            self._record_request(REQUEST_METHODS[action], self.request_local.status, elapsed)
+    
+    def _record_request(self, method, status, elapsed):
+        """记录请求数和延迟，只写当前线程的指标分片，不增加锁竞争"""
+        self.metrics.add('webdav_requests_total', labels=(('method', method), ('status', str(status or 'error'))))
+        if status is not None:
+            self.metrics.observe('webdav_request_seconds', elapsed, (('method', method),))
+    
+    def pool_metrics(self):
+        """返回连接池指标"""
+        return self.pool_stats.snapshot()
+    
+    def _reaper(self):
+        """定期关闭空闲过久的连接，直到监控停止"""
+        while not self.stop_flag.wait(self.transport.idle_timeout):
+            try:
+                self.transport.reap_idle()
+            except Exception as e:
+                logging.debug(f"回收空闲连接时出错: {e}")
     
     def _load_processed_files(self):
-        """加载已处理文件记录"""
-        processed_files = set()
-        if os.path.exists(self.file_tracker):
+        """加载已处理文件索引，内存中只保留布隆过滤器，查询时到数据库确认"""
+        return ProcessedFileIndex(self.file_tracker)
+
+    def _check_index_db(self):
+        """检查记录数据库是否损坏，损坏时改名保留，之后按空索引启动并从本地文件重建"""
+        if not os.path.exists(self.file_tracker):
+            return
+        try:
+            conn = sqlite3.connect(self.file_tracker, timeout=60)
             try:
-                # 使用数据库而不是文本文件来存储已处理文件
-                conn = sqlite3.connect(self.file_tracker)
-                cursor = conn.cursor()
-                # 确保表存在
-                cursor.execute('''
-                CREATE TABLE IF NOT EXISTS processed_files (
-                    path TEXT PRIMARY KEY
-                )''')
-                conn.commit()
-                
-                # 读取所有记录
-                cursor.execute("SELECT path FROM processed_files")
-                for row in cursor.fetchall():
-                    processed_files.add(row[0])
+                result = conn.execute("PRAGMA quick_check").fetchone()[0]
+            finally:
                 conn.close()
-                return processed_files
-            except Exception as e:
-                logging.warning(f"从数据库加载处理记录失败: {e}，尝试从文本文件加载")
-                # 如果数据库读取失败，尝试从旧格式的文本文件读取
-                try:
-                    with open(self.file_tracker, 'r') as f:
-                        return set(line.strip() for line in f.readlines())
-                except Exception as e2:
-                    logging.error(f"加载处理记录失败: {e2}")
-                    return set()
-        return processed_files
-    
-    def _save_processed_file(self, file_path):
+            if result == 'ok':
+                return
+            logging.error(f"记录数据库校验失败: {result}")
+        except sqlite3.DatabaseError as e:
+            logging.error(f"记录数据库已损坏: {e}")
+
+        suffix = time.strftime('.corrupt-%Y%m%d%H%M%S')
+        for path in (self.file_tracker, self.file_tracker + '-wal', self.file_tracker + '-shm'):
+            if os.path.exists(path):
+                os.replace(path, path + suffix)
+        bloom_path = os.path.splitext(self.file_tracker)[0] + '.bloom'
+        if os.path.exists(bloom_path):
+            os.remove(bloom_path)
+        logging.warning(f"已将损坏的记录数据库改名为 {os.path.basename(self.file_tracker)}{suffix}，将从本地文件重建索引")
+
+    def _bootstrap_processed_files(self):
+        """从local_dir中已有的文件重建已处理文件索引
+
+        按目录分发到线程池并行os.scandir，本地路径去掉local_dir前缀即为远程路径。
+        bootstrap_reconcile开启时记录本地文件大小，首次扫描时_needs_download与远程列表比较，
+        大小不同的文件重新下载，相同的直接采用远程元数据；否则只记录路径，全部视为已下载。
+        替换过IP的STRM文件大小与远程不同，不记录大小。在数据库工作线程处理队列任务之前运行，
+        直接使用工作线程的写连接批量写入。
+        """
+        root = os.path.join(self.local_dir, self.remote_dir.strip('/'))
+        if not os.path.isdir(root):
+            return 0
+
+        start_time = time.time()
+        logging.info(f"开始从本地目录 {root} 重建已处理文件索引...")
+        total = 0
+        batch = []
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.list_workers)) as executor:
+                futures = {executor.submit(self._bootstrap_directory, root)}
+                while futures:
+                    done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            subdirs, records = future.result()
+                        except Exception as e:
+                            logging.error(f"重建索引时读取本地目录出错: {e}")
+                            continue
+                        for subdir in subdirs:
+                            futures.add(executor.submit(self._bootstrap_directory, subdir))
+                        batch.extend(records)
+                        if len(batch) >= 5000:
+                            self._db_write(batch, ())
+                            total += len(batch)
+                            batch = []
+            if batch:
+                self._db_write(batch, ())
+                total += len(batch)
+        except Exception as e:
+            logging.error(f"重建已处理文件索引失败: {e}")
+
+        # 旧过滤器容量按空索引确定，删除后按重建的记录数重新生成
+        if os.path.exists(self.processed_files.filter_path):
+            os.remove(self.processed_files.filter_path)
+        self.processed_files = self._load_processed_files()
+        logging.info(f"已从本地文件重建 {total} 个文件记录，耗时 {time.time() - start_time:.2f}秒")
+        return total
+
+    def _bootstrap_directory(self, local_path):
+        """读取一个本地目录，返回(子目录列表, [(远程路径, 元数据)])，跳过下载过程中的临时文件和记录文件"""
+        rel_dir = os.path.relpath(local_path, self.local_dir).replace(os.sep, '/')
+        rel_dir = '/' if rel_dir == '.' else '/' + rel_dir
+        subdirs = []
+        records = []
+        with os.scandir(local_path) as it:
+            for item in it:
+                if item.is_dir(follow_symlinks=False):
+                    subdirs.append(item.path)
+                    continue
+                name = item.name
+                if (name.endswith(('.part', '.part.validator', '.part.segments', '.tmp'))
+                        or name.startswith(('.processed_files', '.last_scan_time')) or not item.is_file()):
+                    continue
+                size = None
+                if self.bootstrap_reconcile and not (self.replace_ip and name.lower().endswith('.strm')):
+                    size = item.stat().st_size
+                records.append((join_remote_path(rel_dir, name), (None, size, None)))
+        return subdirs, records
+
+    def _save_processed_file(self, file_path, etag=None, size=None, mtime=None):
         """将文件记录请求添加到队列"""
-        # 立即更新内存中的集合，不需要等待数据库操作
-        self.processed_files.add(file_path)
+        meta = (etag, size, mtime)
+        # 立即更新内存中的索引，不需要等待数据库操作
+        self.processed_files[file_path] = meta
         # 添加到数据库队列
-        self.db_queue.put({'type': 'save_file', 'file_path': file_path})
+        self.db_queue.put({'type': 'save_file', 'file_path': file_path, 'meta': meta})
+    
+    def _save_strm_record(self, file_path, mtime):
+        """记录本地STRM文件(相对local_dir的路径)已按当前replace_ip处理，以及处理后的修改时间"""
+        self.db_queue.put({'type': 'save_strm', 'record': (file_path, mtime, self.replace_ip)})
     
     def _load_last_scan_time(self):
         """加载上次扫描时间"""
@@ -295,10 +1799,130 @@ class WebdavMonitor:
             f.write(str(current_time))
         self.last_scan_time = current_time
     
-    def _is_file_new(self, file_path):
-        """检查文件是否为新文件"""
-        # 使用哈希表查找效率高
-        return file_path not in self.processed_files
+    def _needs_download(self, entry):
+        """根据列表中的元数据判断文件是否需要下载：新文件，或etag/大小/修改时间发生变化的文件"""
+        meta = self.processed_files.get(entry.path)
+        if meta is None:
+            return True
+        etag, size, mtime = meta
+        if etag is None and size is None and mtime is None:
+            # 旧版本记录没有元数据，直接采用当前元数据，避免升级后全部重新下载
+            self._save_processed_file(entry.path, entry.etag, entry.size, entry.mtime)
+            return False
+        if etag is None and mtime is None:
+            # 从本地文件重建的记录只有大小：大小一致时采用当前元数据，不一致时重新下载
+            if entry.size is not None and size != entry.size:
+                return True
+            if entry.etag or entry.mtime:
+                self._save_processed_file(entry.path, entry.etag, entry.size, entry.mtime)
+            return False
+        if etag and entry.etag:
+            return etag != entry.etag
+        if size is not None and entry.size is not None and size != entry.size:
+            return True
+        return bool(mtime and entry.mtime and mtime != entry.mtime)
+    
+    def _load_dir_state(self):
+        """加载目录状态记录: {路径: (etag, 修改时间, 子条目数, 检查间隔, 下次检查时间)}"""
+        dir_state = {}
+        if os.path.exists(self.file_tracker):
+            try:
+                conn = sqlite3.connect(self.file_tracker)
+                ensure_db_schema(conn)
+                cursor = conn.execute(
+                    "SELECT path, etag, mtime, child_count, check_interval, next_check FROM directories "
+                    "WHERE etag IS NOT NULL OR mtime IS NOT NULL OR next_check IS NOT NULL")
+                for path, etag, mtime, child_count, interval, next_check in cursor:
+                    dir_state[path] = (etag, mtime, child_count, interval, next_check)
+                conn.close()
+            except Exception as e:
+                logging.warning(f"加载目录状态记录失败: {e}，将进行完整扫描")
+        return dir_state
+    
+    def _save_dir_state(self, path, etag, mtime, child_count, interval=None, next_check=None):
+        """记录目录状态和下次检查时间，先更新内存再交给数据库线程写入"""
+        self.dir_state[path] = (etag, mtime, child_count, interval, next_check)
+        self.db_queue.put({'type': 'save_dir', 'state': (path, etag, mtime, child_count, interval, next_check)})
+    
+    def _invalidate_dir_state(self, path):
+        """清除目录及其所有上级目录的状态，确保下次扫描时重新列出"""
+        root = '/' + self.remote_dir.strip('/')
+        path = '/' + path.strip('/')
+        while True:
+            state = self.dir_state.get(path)
+            if state is not None and (state[:2] != (None, None) or state[4] is not None):
+                self._save_dir_state(path, None, None, None)
+            if path == root or path == '/' or not path.startswith(root):
+                break
+            path = os.path.dirname(path)
+    
+    def _is_dir_unchanged(self, entry):
+        """判断子目录自上次扫描后是否未变化且还没到下次检查时间，可以跳过"""
+        if self.full_scan:
+            return False
+        if entry.etag is None and entry.mtime is None:
+            return False
+        state = self.dir_state.get(entry.path)
+        if state is None:
+            return False
+        return state[0] == entry.etag and state[1] == entry.mtime and not self._is_dir_due(state)
+    
+    def _is_dir_due(self, state, now=None):
+        """目录是否到了下次检查时间；没有记录检查时间(新目录或已失效)的目录总是到期
+
+        下次检查时间按扫描开始时间计算，扫描等待时间可能有微小误差，提前不到一成检查间隔的也视为到期。
+        """
+        next_check = state[4]
+        return next_check is None or next_check <= (now or time.time()) + self.check_interval * 0.1
+    
+    def _next_dir_check(self, previous, changed):
+        """根据本次列出的结果计算目录的检查间隔和下次检查时间
+
+        有变化的目录按check_interval检查，没有变化的目录间隔逐次加倍，最长max_dir_interval。
+        下次检查时间从本次扫描开始时计算：到期判断在扫描开始时进行，从列出时计算的话
+        按check_interval检查的目录在下一次扫描时还没有到期，实际间隔会变成两倍。
+        """
+        if changed or previous is None or not previous[3]:
+            interval = self.check_interval
+        else:
+            interval = min(previous[3] * 2, self.max_dir_interval)
+        return interval, self.scan_started + interval
+    
+    def _scan_roots(self, directories, full_scan):
+        """本次扫描的起始目录
+
+        增量扫描时除了监控根目录，还直接列出所有到期的目录：上级目录元数据不变时也不会错过经常变化的子目录。
+        """
+        roots = [DavEntry('/' + d.strip('/'), True) for d in directories]
+        if full_scan:
+            return roots
+        now = time.time()
+        prefixes = [root.path.rstrip('/') + '/' for root in roots]
+        due = [DavEntry(path, True, mtime=state[1]) for path, state in list(self.dir_state.items())
+               if self._is_dir_due(state, now) and path.startswith(tuple(prefixes))]
+        if due:
+            logging.info(f"增量扫描：另外列出 {len(due)} 个到期的目录")
+        return roots + due
+    
+    def _list_failed(self, directory, error):
+        """处理列出目录失败：目录已被删除时清除其状态，否则保证它及其上级目录下次重新扫描"""
+        if is_not_found(error):
+            logging.warning(f"目录已不存在: {directory}")
+            # 不再作为到期目录直接列出；上级目录的列表会反映删除
+            if self.dir_state.pop(directory, None) is not None:
+                self.db_queue.put({'type': 'save_dir', 'state': (directory, None, None, None, None, None)})
+            return
+        logging.error(f"处理目录 {directory} 时出错: {error}")
+        # 列出失败的目录及其上级目录下次必须重新扫描
+        self._invalidate_dir_state(directory)
+    
+    def _claim_directory(self, path):
+        """一次扫描中每个目录只列出一次(到期目录也可能经上级目录到达)，已列出时返回False"""
+        with self.stats_lock:
+            if path in self.listed_dirs:
+                return False
+            self.listed_dirs.add(path)
+            return True
     
     def _encode_path(self, path):
         """编码路径，处理特殊字符和中文字符问题"""
@@ -340,8 +1964,321 @@ class WebdavMonitor:
             logging.error(f"编码路径 {path} 时出错: {e}")
             return path
     
-    def _download_file(self, remote_path):
-        """下载文件到本地"""
+    def _href_prefix(self):
+        """服务器地址中的路径前缀(如 http://host/dav 中的 /dav)，解析href时需要去除"""
+        return urllib.parse.unquote(urllib.parse.urlsplit(self.client.get_url('')).path).rstrip('/')
+
+    def _list_directory(self, directory):
+        """使用一次Depth:1 PROPFIND列出目录
+
+        :return: (目录自身的DavEntry, 子条目的DavEntry列表)，服务器未返回目录自身时第一项为None
+        """
+        with self._dav_request(
+            'list',
+            Urn(directory, directory=True).quote(),
+            data=PROPFIND_BODY,
+            headers_ext=['Content-Type: application/xml; charset="utf-8"']
+        ) as response:
+            content = self._read_body(response)
+        return self._parse_listing(directory, content)
+
+    def _parse_listing(self, directory, content):
+        """解析Depth:1 PROPFIND的响应体，返回(目录自身的DavEntry, 子条目的DavEntry列表)"""
+        tree = etree.fromstring(content)
+        self_path = '/' + directory.strip('/')
+        href_prefix = self._href_prefix()
+        self_entry = None
+        entries = []
+        for response_el in tree.iterfind('{DAV:}response'):
+            entry = parse_dav_response(response_el, href_prefix)
+            if entry is None:
+                continue
+            if entry.path == self_path:
+                self_entry = entry
+                continue
+            entries.append(entry)
+        return self_entry, entries
+
+    def _stream_tree(self, root):
+        """使用一次Depth:infinity PROPFIND获取整棵目录树，边接收边解析，逐个产出DavEntry
+
+        使用lxml iterparse增量解析响应流，每处理完一个<D:response>就释放对应节点，
+        内存占用与目录树大小无关。
+        """
+        with self._dav_request(
+            'list',
+            Urn(root, directory=True).quote(),
+            data=PROPFIND_BODY,
+            headers_ext=['Depth: infinity', 'Content-Type: application/xml; charset="utf-8"'],
+            streaming=True
+        ) as response:
+            # 让urllib3处理gzip等传输编码，iterparse直接读取原始响应流
+            response.raw.decode_content = True
+            href_prefix = self._href_prefix()
+            for _, element in etree.iterparse(response.raw, events=('end',), tag='{DAV:}response'):
+                entry = parse_dav_response(element, href_prefix)
+                # 释放已处理的节点，保持内存平稳
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+                if entry is not None:
+                    yield entry
+    
+    def _scan_infinity(self, root):
+        """使用Depth:infinity模式扫描，新文件边解析边提交下载
+
+        :return: 需要改用逐目录方式列出的目录DavEntry列表；None表示服务器拒绝该模式，需要完整回退
+        """
+        root_path = '/' + root.strip('/')
+        entry_count = 0
+        # 服务器可能忽略Depth:infinity而按Depth:1返回，此时需要逐个列出这些子目录
+        child_dirs = []
+        nested_seen = False
+        try:
+            for entry in self._stream_tree(root):
+                entry_count += 1
+                if entry.path == root_path:
+                    # 按请求扫描单个文件时，返回的唯一条目就是该文件本身
+                    if not entry.is_dir and self._needs_download(entry):
+                        self.download_queue.put(entry)
+                    continue
+                if not nested_seen:
+                    if os.path.dirname(entry.path) != root_path:
+                        # 已收到更深层的条目，说明服务器确实按Depth:infinity返回
+                        nested_seen = True
+                        child_dirs = []
+                    elif entry.is_dir:
+                        child_dirs.append(entry)
+                if entry.is_dir:
+                    continue
+                if self._needs_download(entry):
+                    self.download_queue.put(entry)
+        except (MethodNotSupported, ResponseErrorCode) as e:
+            if entry_count == 0:
+                logging.warning(f"服务器拒绝Depth:infinity请求({e})，改用逐目录列出")
+                self.infinity_supported = False
+                return None
+            logging.error(f"Depth:infinity扫描中断: {e}")
+            return []
+        except Exception as e:
+            if entry_count == 0:
+                logging.warning(f"Depth:infinity请求失败({e})，本次改用逐目录列出")
+                return None
+            logging.error(f"Depth:infinity扫描中断，已处理 {entry_count} 个条目: {e}")
+            return []
+        
+        if nested_seen:
+            child_dirs = []
+        elif child_dirs:
+            logging.warning("服务器未返回子目录内容，可能不支持Depth:infinity，改用逐目录列出")
+            self.infinity_supported = False
+        logging.info(f"Depth:infinity扫描完成，共解析 {entry_count} 个条目")
+        return child_dirs
+    
+    def _fetch_file(self, remote_path, local_path, headers_ext=None, entry=None):
+        """用一次GET请求下载文件：先写入.part文件，完整后再替换到目标位置
+
+        .part文件已存在且校验值与列表中的一致时，使用Range/If-Range从中断处继续下载；
+        服务器判断文件已变化时返回完整内容，从头重新下载。
+
+        :param headers_ext: 附加请求头，例如条件请求的If-None-Match/If-Modified-Since
+        :param entry: 列表中该文件的DavEntry，用于续传校验和大小检查
+        :return: False表示服务器返回304，文件未修改，本地文件保持不变
+        """
+        validator = entry_validator(entry)
+        part_path, offset = open_part_file(local_path, validator)
+        # 续传按字节偏移计算，不能使用压缩传输
+        headers = list(headers_ext or []) + ['Accept-Encoding: identity']
+        if offset:
+            headers += [f'Range: bytes={offset}-', f'If-Range: {validator}']
+        
+        with self._dav_request('download', Urn(remote_path).quote(), headers_ext=headers) as response:
+            if response.status_code == 304:
+                return False
+            if response.status_code == 206 and offset:
+                mode = 'ab'
+                logging.info(f"从 {offset} 字节处继续下载: {remote_path}")
+            else:
+                offset = 0
+                mode = 'wb'
+                start_part_file(part_path, validator)
+            content_length = response.headers.get('Content-Length')
+            expected_size = offset + int(content_length) if content_length else (entry.size if entry else None)
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=self.client.chunk_size):
+                    self._received(len(chunk))
+                    f.write(chunk)
+        
+        finish_part_file(part_path, local_path, expected_size)
+        return True
+    
+    def _fetch(self, remote_path, local_path, headers_ext=None, entry=None):
+        """下载非STRM文件：超过分段阈值的大文件分段并行下载，否则(或无法分段时)单连接下载"""
+        if self._should_segment(entry):
+            modified = self._fetch_segmented(remote_path, local_path, headers_ext, entry)
+            if modified is not None:
+                return modified
+        return self._fetch_file(remote_path, local_path, headers_ext, entry)
+    
+    def _should_segment(self, entry):
+        return (entry is not None and entry.size is not None and self.max_segments > 1
+                and self.segments_per_file > 1 and entry.size > max(self.segment_threshold, SEGMENT_UNIT_SIZE)
+                and entry_validator(entry) is not None)
+    
+    def _acquire_segments(self, size):
+        """按文件大小、单文件上限和当前自适应并发上限获取分段名额，不等待，返回获得的名额数"""
+        units = (size + SEGMENT_UNIT_SIZE - 1) // SEGMENT_UNIT_SIZE
+        wanted = min(self.segments_per_file, units, max(1, int(self.concurrency.limit) // 2))
+        granted = 0
+        while granted < wanted and self.segment_slots.acquire(blocking=False):
+            granted += 1
+        return granted
+    
+    def _release_segments(self, count):
+        for _ in range(count):
+            self.segment_slots.release()
+    
+    def _prepare_segments(self, local_path, validator, size):
+        """准备分段下载的.part文件，返回(.part路径, 已完成的分块集合, 待下载的分块列表)"""
+        part_path = local_path + '.part'
+        done = load_segment_progress(part_path, validator, size)
+        if done is None:
+            done = set()
+            preallocate_file(part_path, size)
+            # 分段写入的.part不是连续前缀，不能按单连接方式续传
+            start_part_file(part_path, None)
+            save_segment_progress(part_path, validator, size, done)
+        elif done:
+            logging.info(f"继续分段下载，已完成 {len(done)} 个分块: {local_path}")
+        units = (size + SEGMENT_UNIT_SIZE - 1) // SEGMENT_UNIT_SIZE
+        return part_path, done, [i for i in range(units) if i not in done]
+    
+    def _segment_headers(self, unit, size, validator, headers_ext=None):
+        start = unit * SEGMENT_UNIT_SIZE
+        end = min(size, start + SEGMENT_UNIT_SIZE) - 1
+        headers = list(headers_ext or []) + [
+            'Accept-Encoding: identity', f'Range: bytes={start}-{end}', f'If-Range: {validator}']
+        return start, end, headers
+    
+    def _fetch_segmented(self, remote_path, local_path, headers_ext, entry):
+        """把大文件分成多个分块，用多个连接并发下载，按位置写入预先分配的.part文件
+
+        :return: 与_fetch_file相同；None表示没有空闲的分段名额或服务器不支持Range，需要改用单连接下载
+        """
+        workers = self._acquire_segments(entry.size)
+        if workers < 2:
+            self._release_segments(workers)
+            return None
+        try:
+            validator = entry_validator(entry)
+            part_path, done, pending = self._prepare_segments(local_path, validator, entry.size)
+            
+            state = {'lock': threading.Lock(), 'part_path': part_path, 'done': done, 'pending': pending,
+                     'failed': threading.Event(), 'not_modified': False}
+            fd = os.open(part_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            try:
+                futures = [self.segment_executor.submit(
+                               self._segment_worker, remote_path, fd, entry.size, validator, headers_ext, state)
+                           for _ in range(min(workers, len(pending)))]
+                # 所有分段线程结束后再检查结果，第一个异常向上抛出
+                errors = [future.exception() for future in futures]
+            finally:
+                os.close(fd)
+            return self._finish_segments(part_path, local_path, entry.size, state, errors)
+        finally:
+            self._release_segments(workers)
+    
+    def _finish_segments(self, part_path, local_path, size, state, errors):
+        """检查所有分块的结果：全部完成时替换到目标位置"""
+        for error in errors:
+            if isinstance(error, SegmentUnsupported):
+                logging.info(f"服务器不支持分段下载，改用单连接下载: {local_path}")
+                os.remove(part_path + '.segments')
+                return None
+        for error in errors:
+            if error is not None:
+                raise error
+        if state['not_modified']:
+            for path in (part_path, part_path + '.segments'):
+                os.remove(path)
+            return False
+        finish_part_file(part_path, local_path, size)
+        os.remove(part_path + '.segments')
+        return True
+    
+    def _segment_worker(self, remote_path, fd, size, validator, headers_ext, state):
+        """分段下载线程：依次取未完成的分块，用Range请求下载并写入对应位置"""
+        while not state['failed'].is_set():
+            with state['lock']:
+                if not state['pending']:
+                    return
+                unit = state['pending'].pop(0)
+            start, end, headers = self._segment_headers(unit, size, validator, headers_ext)
+            try:
+                with self._dav_request('download', Urn(remote_path).quote(), headers_ext=headers) as response:
+                    if response.status_code == 304:
+                        state['not_modified'] = True
+                        state['failed'].set()
+                        return
+                    if response.status_code != 206 or parse_content_range_start(response.headers.get('Content-Range')) != start:
+                        raise SegmentUnsupported()
+                    offset = start
+                    for chunk in response.iter_content(chunk_size=self.client.chunk_size):
+                        self._received(len(chunk))
+                        write_at(fd, chunk, offset)
+                        offset += len(chunk)
+                if offset != end + 1:
+                    raise IOError(f"分块下载不完整: {start}-{end}，已接收到 {offset}")
+            except Exception:
+                state['failed'].set()
+                raise
+            with state['lock']:
+                state['done'].add(unit)
+                save_segment_progress(state['part_path'], validator, size, state['done'])
+    
+    def _fetch_strm(self, remote_path, local_path, headers_ext=None):
+        """STRM小文件的快速路径：内容读入内存，替换IP后一次性原子写入
+
+        :return: (是否有变化, 是否替换了IP)；服务器返回304或最终内容与本地文件完全相同时不写入
+        """
+        with self._dav_request('download', Urn(remote_path).quote(), headers_ext=headers_ext) as response:
+            if response.status_code == 304:
+                return False, False
+            data = self._read_body(response)
+        
+        new_data = rewrite_strm_bytes(data, self.replace_ip)
+        processed = new_data != data
+        
+        # 与本地内容完全相同时跳过写入，避免无意义的磁盘写和媒体库刷新
+        try:
+            if os.path.getsize(local_path) == len(new_data):
+                with open(local_path, 'rb') as f:
+                    if f.read() == new_data:
+                        return False, False
+        except OSError:
+            pass
+        
+        write_file_atomic(local_path, new_data)
+        return True, processed
+    
+    def _conditional_headers(self, remote_path, local_path):
+        """本地文件存在且有旧的元数据记录时，生成条件请求头"""
+        meta = self.processed_files.get(remote_path)
+        if meta is None or not os.path.exists(local_path):
+            return None
+        etag, size, mtime = meta
+        headers = []
+        if etag:
+            headers.append(f"If-None-Match: {quote_etag(etag)}")
+        if mtime:
+            headers.append(f"If-Modified-Since: {formatdate(mtime, usegmt=True)}")
+        return headers or None
+    
+    def _download_file(self, remote_path, entry=None):
+        """下载文件到本地
+
+        :param entry: 列表中该文件的DavEntry，用于记录etag/大小/修改时间；已下载过的文件使用条件请求
+        """
         try:
             # 创建相对路径，保持目录结构
             relative_path = remote_path.lstrip('/')
@@ -350,27 +2287,36 @@ class WebdavMonitor:
             # 确保目标目录存在
             os.makedirs(os.path.dirname(local_path), exist_ok=True)
             
+            # 已下载过的文件使用条件请求，内容未变化时服务器只返回304
+            headers_ext = self._conditional_headers(remote_path, local_path)
+            
+            # STRM小文件在内存中下载并替换IP，只写一次磁盘
+            in_memory = local_path.lower().endswith('.strm') and (
+                entry is None or entry.size is None or entry.size <= STRM_INMEMORY_MAX_SIZE)
+            
             # 下载文件
             success = False
+            modified = True
+            strm_processed = False
             retry_count = 0
             max_retries = 3
             last_error = None
+            start = time.monotonic()
             
             while retry_count < max_retries and not success:
                 try:
-                    self.client.download_file(remote_path, local_path)
+                    if in_memory:
+                        modified, strm_processed = self._fetch_strm(remote_path, local_path, headers_ext)
+                    else:
+                        modified = self._fetch(remote_path, local_path, headers_ext, entry)
                     success = True
                 except Exception as e:
                     last_error = e
                     retry_count += 1
                     logging.error(f"下载文件时出错: {e}, 重试 ({retry_count}/{max_retries})")
-                    
-                    # 如果是连接池满的错误，等待较长时间后重试
-                    if "Connection pool is full" in str(e):
-                        logging.warning(f"连接池已满，等待后重试...")
-                        time.sleep(5)  # 等待更长时间
-                    else:
-                        time.sleep(1)
+                    if retry_count < max_retries:
+                        self.scan_profile.retry('download')
+                    time.sleep(1)
                         
                     # 如果达到最大重试次数，尝试使用编码后的路径
                     if retry_count == max_retries and not success:
@@ -378,234 +2324,372 @@ class WebdavMonitor:
                         if encoded_path != remote_path:
                             try:
                                 logging.debug(f"尝试使用编码路径: {encoded_path}")
-                                self.client.download_file(encoded_path, local_path)
+                                if in_memory:
+                                    modified, strm_processed = self._fetch_strm(encoded_path, local_path, headers_ext)
+                                else:
+                                    modified = self._fetch(encoded_path, local_path, headers_ext, entry)
                                 success = True
                             except Exception as e2:
                                 logging.error(f"使用编码路径下载文件时出错: {e2}")
             
+            self.scan_profile.record('download', remote_path, time.monotonic() - start, entry.size if entry else None)
             if success:
-                # 添加到已处理文件列表
-                self._save_processed_file(remote_path)
-                
-                # 获取文件所在的远程目录
-                remote_dir = os.path.dirname(remote_path)
-                if not remote_dir:
-                    remote_dir = '/'
-                
-                # 更新下载统计
-                with self.stats_lock:
-                    self.download_count += 1
-                    # 记录下载的文件
-                    self.downloaded_files.append(remote_path)
-                    
-                    # 更新目录统计
-                    if remote_dir not in self.dir_stats:
-                        self.dir_stats[remote_dir] = {'downloads': 0, 'processed': 0}
-                    self.dir_stats[remote_dir]['downloads'] += 1
-                
-                # 处理STRM文件内容，替换IP为域名
-                if self.replace_ip and local_path.lower().endswith('.strm'):
-                    processed = process_strm_content(local_path, self.replace_ip)
-                    if processed:
-                        with self.stats_lock:
-                            self.processed_count += 1
-                            self.dir_stats[remote_dir]['processed'] += 1
-                
-                # 执行下载后命令
-                if self.post_download_command:
-                    self._execute_post_download(local_path)
-                
-                return True
+                start = time.monotonic()
+                try:
+                    return self._finish_download(remote_path, local_path, entry, modified, strm_processed, in_memory)
+                finally:
+                    self.scan_profile.record('post', remote_path, time.monotonic() - start)
             else:
-                # 更新错误统计
-                with self.stats_lock:
-                    self.error_count += 1
+                self._download_failed(remote_path)
                 return False
                 
         except Exception as e:
             logging.error(f"处理下载文件 {remote_path} 时出错: {e}")
-            # 更新错误统计
-            with self.stats_lock:
-                self.error_count += 1
+            self._download_failed(remote_path)
             return False
     
-    def _execute_post_download(self, local_path):
-        """执行下载后命令"""
-        try:
-            if not self.post_download_command:
-                return
-                
-            # 替换命令中的占位符
-            cmd = self.post_download_command.replace('{local_path}', local_path)
-            
-            # 执行命令
-            logging.debug(f"执行下载后命令")
-            process = subprocess.Popen(
-                shlex.split(cmd), 
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            stdout, stderr = process.communicate()
+    def _finish_download(self, remote_path, local_path, entry, modified, strm_processed=False, in_memory=False):
+        """下载成功后记录元数据、更新统计、处理STRM内容并执行下载后命令
+
+        :param in_memory: 是否走了STRM快速路径，此时strm_processed表示写入前是否已替换IP
+        """
+        # 添加到已处理文件列表，同时记录元数据供下次比较
+        if entry is not None:
+            self._save_processed_file(remote_path, entry.etag, entry.size, entry.mtime)
+        else:
+            self._save_processed_file(remote_path)
+        
+        if not modified:
+            # 服务器返回304或内容与本地完全相同，只更新元数据
+            logging.debug(f"文件未修改: {remote_path}")
+            with self.stats_lock:
+                self.not_modified_count += 1
+            self.metrics.add('webdav_not_modified_files_total')
+            return True
+        
+        # 获取文件所在的远程目录
+        remote_dir = os.path.dirname(remote_path)
+        if not remote_dir:
+            remote_dir = '/'
+        
+        # 更新下载统计
+        with self.stats_lock:
+            self.download_count += 1
+            # 记录下载的文件
+            self.downloaded_files.append(remote_path)
             
-            if process.returncode == 0:
-                logging.debug(f"命令执行成功")
-            else:
-                logging.error(f"命令执行失败")
-                
-        except Exception as e:
-            logging.error(f"执行下载后命令时出错")
+            # 更新目录统计
+            if remote_dir not in self.dir_stats:
+                self.dir_stats[remote_dir] = {'downloads': 0, 'processed': 0}
+            self.dir_stats[remote_dir]['downloads'] += 1
+        self.metrics.add('webdav_downloaded_files_total')
+        
+        # 处理STRM文件内容，替换IP为域名（快速路径已在写入前完成替换）
+        if self.replace_ip and local_path.lower().endswith('.strm'):
+            processed = strm_processed if in_memory else process_strm_content(local_path, self.replace_ip)
+            if processed:
+                with self.stats_lock:
+                    self.processed_count += 1
+                    self.dir_stats[remote_dir]['processed'] += 1
+                self.metrics.add('webdav_strm_processed_total')
+            self._save_strm_record(remote_path, os.path.getmtime(local_path))
+        
+        # 执行下载后命令
+        if self.post_download_command:
+            self._execute_post_download(local_path)
+        
+        return True
     
-    def _download_worker(self, item):
-        """下载工作线程，由线程池调用"""
-        remote_path = item
-        if self._is_file_new(remote_path):
-            return self._download_file(remote_path)
-        return False
+    def _download_failed(self, remote_path):
+        """更新错误统计，并保证文件所在目录下次会被重新扫描"""
+        with self.stats_lock:
+            self.error_count += 1
+        self.metrics.add('webdav_download_errors_total')
+        self._invalidate_dir_state(os.path.dirname(remote_path))
     
-    def _find_and_download_files(self, directory=None):
-        """递归查找所有文件并立即添加到下载线程池"""
+    def _execute_post_download(self, local_path):
+        """将下载完成的文件交给下载后命令执行器"""
+        if self.post_commands is not None:
+            self.post_commands.submit(local_path)
+    
+    def _download_worker(self):
+        """下载工作线程：从下载队列取文件下载，收到None时退出"""
+        while True:
+            entry = self.download_queue.get()
+            try:
+                if entry is None:
+                    return
+                if self.stop_flag.is_set():
+                    # 停止时放弃剩余下载，保证所在目录下次会被重新扫描
+                    self._invalidate_dir_state(os.path.dirname(entry.path))
+                elif self._needs_download(entry):
+                    with self._active('download'):
+                        self._download_file(entry.path, entry)
+            except Exception as e:
+                logging.error(f"处理下载文件 {entry.path} 时出错: {e}")
+                self._download_failed(entry.path)
+            finally:
+                self.download_queue.task_done()
+    
+    def _find_and_download_files(self, directory=None, full_scan=True):
+        """并行遍历远程目录树，发现的文件立即放入有上限的下载队列，由固定数量的下载线程处理
+
+        :param directory: 遍历的根目录，也可以是多个目录的列表；默认为remote_dir
+        :param full_scan: 是否完整扫描；为False时跳过元数据未变化的子目录
+        """
         if directory is None:
             directory = self.remote_dir
+        directories = [directory] if isinstance(directory, str) else list(directory)
+        self.full_scan = full_scan
+        self._reset_scan_stats(directories, full_scan)
         
-        # 重置本次扫描的统计信息
-        self.download_count = 0
-        self.error_count = 0
-        self.processed_count = 0
-        self.dir_stats = {}  # 重置目录统计
-        # 记录新增的文件列表
-        self.downloaded_files = []
+        # 启动下载线程
+        downloaders = []
+        for i in range(max(1, self.max_workers)):
+            t = threading.Thread(target=self._download_worker, name=f"downloader-{i}", daemon=True)
+            t.start()
+            downloaders.append(t)
         
-        # 创建线程池
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+        try:
             # 开始查找和下载过程
-            self._find_files(directory, executor, futures=None, depth=0)
+            roots = self._scan_roots(directories, full_scan)
+            if self.depth_infinity and self.infinity_supported and len(directories) == 1:
+                pending_dirs = self._scan_infinity(directories[0])
+                if pending_dirs is not None:
+                    roots = pending_dirs
+            if roots:
+                self._traverse(roots)
             
             # 等待所有下载任务完成
-            executor.shutdown(wait=True)
+            self.download_queue.join()
+        finally:
+            # 通知下载线程退出
+            for _ in downloaders:
+                self.download_queue.put(None)
+            for t in downloaders:
+                t.join()
         
         return self.download_count, self.error_count, self.processed_count, self.downloaded_files
     
-    def _find_files(self, directory, executor, futures=None, depth=0):
-        """递归查找文件并提交到线程池下载"""
-        if futures is None:
-            futures = []
-            
-        if depth > 20:  # 添加最大递归深度限制
-            logging.warning(f"已达到最大递归深度({depth})，跳过目录: {directory}")
-            return futures
-            
+    def _transfer_totals(self):
+        """返回累计的(请求数, 接收字节数)，扫描报告用开始和结束时的差值"""
+        totals = self.metrics.collect()
+        requests = sum(value for (name, _), value in totals.items() if name == 'webdav_requests_total')
+        return requests, totals.get(('webdav_received_bytes_total', ()), 0)
+    
+    def _post_command_seconds(self):
+        if self.post_commands is None:
+            return 0.0
+        with self.post_commands.lock:
+            return self.post_commands.stats['total_seconds']
+    
+    def _record_scan(self, elapsed_time):
+        """扫描结束时记录扫描耗时指标，并把本次扫描的性能报告交给数据库线程保存"""
+        profile = self.scan_profile
+        self.metrics.observe('webdav_scan_seconds', elapsed_time, (('kind', profile.kind),))
+        requests, received = self._transfer_totals()
+        with self.stats_lock:
+            counts = {
+                'downloads': self.download_count,
+                'errors': self.error_count,
+                'not_modified': self.not_modified_count,
+                'strm_processed': self.processed_count,
+                'skipped_dirs': self.skipped_dirs,
+                'listed_dirs': len(self.listed_dirs),
+            }
+        report = profile.report(
+            elapsed_time, requests - self.scan_baseline[0], received - self.scan_baseline[1],
+            post_command_seconds=round(self._post_command_seconds() - self.scan_post_seconds, 3), **counts)
+        self.db_queue.put({'type': 'save_scan', 'started_at': profile.started_at, 'report': report})
+        return report
+    
+    @contextlib.contextmanager
+    def _active(self, role):
+        """with块执行期间计入正在工作的线程数"""
+        labels = (('role', role),)
+        self.metrics.add('webdav_active_workers', 1, labels)
         try:
+            yield
+        finally:
+            self.metrics.add('webdav_active_workers', -1, labels)
+    
+    def _reset_scan_stats(self, directories=(), full_scan=True):
+        """重置本次扫描的统计信息，开始记录本次扫描的性能报告"""
+        if list(directories) in ([], [self.remote_dir]):
+            kind = 'full' if full_scan else 'incremental'
+        else:
+            kind = 'subtree'
+        self.scan_started = time.time()  # 目录的下次检查时间从扫描开始时计算
+        self.scan_profile = ScanProfile(kind, directories or [self.remote_dir])
+        self.scan_baseline = self._transfer_totals()
+        self.scan_post_seconds = self._post_command_seconds()  # 本次扫描期间完成的下载后命令耗时按差值计算
+        self.download_count = 0
+        self.error_count = 0
+        self.processed_count = 0
+        self.skipped_dirs = 0
+        self.not_modified_count = 0
+        self.dir_stats = {}  # 重置目录统计
+        self.listed_dirs = set()  # 本次扫描已列出的目录
+        # 只保留最近新增的文件，新增文件再多内存占用也不变
+        self.downloaded_files = deque(maxlen=RECENT_FILES_LIMIT)
+    
+    def _scan_priority(self, entry):
+        """待扫描目录在优先队列中的排序键：配置的热点路径(及其上级目录)最先，其余按修改时间从新到旧"""
+        path = entry.path
+        prefix = path.rstrip('/') + '/'
+        hot = any(path == hot_path or path.startswith(hot_path + '/') or hot_path.startswith(prefix)
+                  for hot_path in self.hot_paths)
+        return (0 if hot else 1, -(entry.mtime or 0), path)
+    
+    def _traverse(self, roots):
+        """使用多个列表线程从共享的待扫描优先队列中取目录并行遍历，直到整棵树处理完毕
+
+        刚修改过的目录先列出，新内容在扫描开始后很快就能下载，不必等待遍历到树的末尾。
+        """
+        frontier = queue.PriorityQueue()
+        for root in roots:
+            frontier.put(self._scan_priority(root))
+        
+        listers = []
+        for i in range(max(1, self.list_workers)):
+            t = threading.Thread(target=self._lister_worker, args=(frontier,), name=f"lister-{i}", daemon=True)
+            t.start()
+            listers.append(t)
+        
+        # 子目录在父目录task_done之前入队，所以join返回时整棵树已经遍历完成
+        frontier.join()
+        
+        # 通知列表线程退出(排在所有目录之后)
+        for _ in listers:
+            frontier.put((2, 0, None))
+        for t in listers:
+            t.join()
+    
+    def _lister_worker(self, frontier):
+        """列表工作线程：列出目录，把子目录放回待扫描队列，把文件放入下载队列"""
+        while True:
+            _, _, directory = frontier.get()
             try:
-                # 获取目录列表
+                if directory is None:
+                    return
+                # 停止时不再列出新目录，只是清空队列，并保证这些目录下次会被重新扫描
+                if self.stop_flag.is_set():
+                    self._invalidate_dir_state(directory)
+                    continue
+                if not self._claim_directory(directory):
+                    continue
+                with self._active('list'):
+                    sub_dirs = self._find_files(directory)
+                for sub_dir in sub_dirs:
+                    frontier.put(self._scan_priority(sub_dir))
+            except Exception as e:
+                logging.warning(f"遍历目录时出错: {directory}, {str(e)}")
+            finally:
+                frontier.task_done()
+    
+    def _find_files(self, directory):
+        """列出单个目录，把新文件放入下载队列(队列已满时等待)，返回需要继续遍历的子目录DavEntry列表"""
+        directories = []
+        try:
+            # 获取目录列表：一次PROPFIND同时得到子条目的类型、大小、etag和修改时间
+            start = time.monotonic()
+            max_retries = 3
+            for retry_count in range(1, max_retries + 1):
                 try:
-                    files = self.client.list(directory)
+                    self_entry, entries = self._list_directory(directory)
+                    break
                 except Exception as e:
-                    logging.error(f"列出目录 {directory} 时出错: {e}")
-                    if "Connection pool is full" in str(e):
-                        logging.warning("连接池已满，重建WebDAV客户端...")
-                        self.client = self._create_client_with_retry(max_retries=3)
-                        # 重试一次
-                        files = self.client.list(directory)
-                    else:
-                        # 尝试使用编码后的路径
-                        encoded_directory = self._encode_path(directory)
-                        if encoded_directory != directory:
-                            logging.debug(f"尝试使用编码后的路径: {encoded_directory}")
-                            files = self.client.list(encoded_directory)
-                        else:
-                            raise
-                
-                # 直接批量处理目录中的文件
-                new_files = []
-                
-                # 收集所有文件和目录
-                directories = []
-                for file_name in files:
-                    # 跳过当前目录
-                    if file_name == directory or file_name == "./":
-                        continue
-                    
-                    # 构建完整路径
-                    file_path = fix_path(directory, file_name)
-                    
-                    try:
-                        is_dir = self.client.is_dir(file_path)
-                    except Exception as e:
-                        logging.warning(f"检查路径是否为目录时出错: {file_path}, {str(e)}")
-                        # 改进判断方法，使用多种方式确定是否为目录
-                        is_dir = False
-                        # 1. 通过路径结尾判断
-                        if file_path.endswith('/'):
-                            is_dir = True
-                        else:
-                            # 2. 尝试列出该路径内容，如果可以列出则为目录
-                            try:
-                                self.client.list(file_path)
-                                is_dir = True
-                            except:
-                                # 3. 检查文件扩展名，如果有明显的文件扩展名则不是目录
-                                file_ext = os.path.splitext(file_path)[1].lower()
-                                is_dir = file_ext == ''
-                        
-                        logging.debug(f"路径 {file_path} 判断结果: {'目录' if is_dir else '文件'}")
-                    
-                    if is_dir:
-                        # 收集目录待后续处理
-                        directories.append(file_path)
-                    else:
-                        # 收集所有可能需要下载的文件
-                        if self._is_file_new(file_path):
-                            new_files.append(file_path)
-                
-                # 批量提交文件下载任务
-                if new_files:
-                    for file_path in new_files:
-                        future = executor.submit(self._download_worker, file_path)
-                        futures.append(future)
-                
-                # 处理完所有文件后再递归处理子目录，减少并行递归深度
-                for dir_path in directories:
-                    try:
-                        self._find_files(dir_path, executor, futures, depth + 1)
-                    except Exception as e:
-                        logging.warning(f"递归查找目录时出错: {dir_path}, {str(e)}")
-                
-            except Exception as e:
-                logging.error(f"处理目录 {directory} 时出错: {e}")
+                    if retry_count == max_retries or is_not_found(e):
+                        raise
+                    # 限流时并发控制器会按Retry-After暂停新请求
+                    logging.warning(f"列出目录 {directory} 时出错: {e}, 重试 ({retry_count}/{max_retries})")
+                    self.scan_profile.retry('list')
+                    time.sleep(1)
+            self.scan_profile.record('list', directory, time.monotonic() - start, len(entries))
+            
+            directories, files = self._classify_entries(directory, self_entry, entries)
+            # 新文件或已变化的文件放入下载队列，队列已满时等待下载线程，形成背压
+            for entry in files:
+                self.download_queue.put(entry)
             
-            return futures
         except Exception as e:
-            logging.error(f"查找文件时出错: {e}")
-            return futures
+            self._list_failed(directory, e)
+        
+        return directories
+    
+    def _classify_entries(self, directory, self_entry, entries):
+        """记录目录状态并区分列表中的条目
+
+        :return: (需要继续遍历的子目录DavEntry列表, 需要下载的文件DavEntry列表)
+        """
+        if self_entry is not None and not self_entry.is_dir:
+            # 按请求扫描的路径是文件(例如变更通知中的新文件)，只检查该文件
+            return [], [self_entry] if self._needs_download(self_entry) else []
+        
+        directories = []
+        files = []
+        # 根据PROPFIND结果区分文件和目录，无需逐个探测
+        for entry in entries:
+            if entry.is_dir:
+                # 元数据未变化且未到检查时间的子目录跳过，其中到期的子目录作为起始目录直接列出
+                if self._is_dir_unchanged(entry):
+                    with self.stats_lock:
+                        # 作为到期目录已经列出过的不计入跳过数
+                        skipped = entry.path not in self.listed_dirs
+                        if skipped:
+                            self.skipped_dirs += 1
+                    if skipped:
+                        self.metrics.add('webdav_skipped_dirs_total')
+                    continue
+                # 收集目录，交给列表线程按修改时间排序后继续处理
+                directories.append(entry)
+            elif self._needs_download(entry):
+                files.append(entry)
+        
+        # 记录目录状态和下次检查时间，供之后的增量扫描比较；先于提交下载记录，下载失败时才能正确清除
+        if self_entry is not None:
+            previous = self.dir_state.get(directory)
+            changed = bool(files) or previous is None or previous[:3] != (self_entry.etag, self_entry.mtime, len(entries))
+            interval, next_check = self._next_dir_check(previous, changed)
+            self._save_dir_state(directory, self_entry.etag, self_entry.mtime, len(entries), interval, next_check)
+        return directories, files
     
     def _process_existing_strm_files(self):
-        """处理已下载的STRM文件内容"""
+        """增量处理已下载的STRM文件内容
+
+        只处理新增、修改过或上次使用其他替换目标处理过的文件；按目录分发到线程池，
+        每个目录只查询一次该目录的处理记录。
+        """
         if not self.replace_ip:
             return 0
             
+        start_time = time.time()
+        checked_count = 0
         processed_count = 0
         # 使用字典来跟踪每个目录中处理的文件数量
         dir_stats = {}
         
         try:
-            logging.info(f"开始处理已下载的STRM文件内容...")
+            logging.info(f"开始在后台增量处理已下载的STRM文件内容...")
             
-            # 遍历本地目录
-            for root, dirs, files in os.walk(self.local_dir):
-                for file in files:
-                    if file.lower().endswith('.strm'):
-                        file_path = os.path.join(root, file)
-                        if process_strm_content(file_path, self.replace_ip):
-                            processed_count += 1
-                            
-                            # 记录目录统计信息
-                            rel_dir = os.path.relpath(root, self.local_dir)
-                            if rel_dir == '.':
-                                rel_dir = '根目录'
-                            if rel_dir not in dir_stats:
-                                dir_stats[rel_dir] = 0
-                            dir_stats[rel_dir] += 1
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.strm_workers) as executor:
+                futures = {executor.submit(self._process_strm_directory, self.local_dir)}
+                while futures:
+                    done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            rel_dir, subdirs, checked, processed = future.result()
+                        except Exception as e:
+                            logging.error(f"处理本地目录中的STRM文件时出错: {e}")
+                            continue
+                        checked_count += checked
+                        if processed:
+                            processed_count += processed
+                            dir_stats[rel_dir if rel_dir != '/' else '根目录'] = processed
+                        if self.stop_flag.is_set():
+                            continue
+                        for subdir in subdirs:
+                            futures.add(executor.submit(self._process_strm_directory, subdir))
             
             # 按照处理的文件数量排序并显示每个目录的统计信息
             if dir_stats:
@@ -613,73 +2697,128 @@ class WebdavMonitor:
                 for dir_path, count in sorted(dir_stats.items(), key=lambda x: x[1], reverse=True):
                     logging.info(f"  - {dir_path}: {count}个文件")
                     
-            logging.info(f"已处理 {processed_count} 个已下载的STRM文件内容")
+            logging.info(f"已检查 {checked_count} 个已下载的STRM文件，处理了其中 {processed_count} 个，"
+                         f"耗时 {time.time() - start_time:.2f}秒")
             return processed_count
         except Exception as e:
             logging.error(f"处理已下载的STRM文件内容时出错: {e}")
             return processed_count
     
+    def _process_strm_directory(self, local_path):
+        """处理一个本地目录中需要替换IP的STRM文件，返回(相对目录, 子目录列表, 检查数, 处理数)"""
+        rel_dir = os.path.relpath(local_path, self.local_dir).replace(os.sep, '/')
+        rel_dir = '/' if rel_dir == '.' else '/' + rel_dir
+        
+        # 该目录中上次处理的记录: 文件名 -> (修改时间, 替换目标)
+        records = {
+            name: (mtime, target)
+            for name, mtime, target in self.processed_files.connection().execute(
+                "SELECT s.name, s.mtime, s.target FROM strm_rewrites s JOIN directories d ON s.dir_id = d.id "
+                "WHERE d.path = ?", (rel_dir,))
+        }
+        
+        subdirs = []
+        checked = 0
+        processed = 0
+        with os.scandir(local_path) as it:
+            for item in it:
+                if item.is_dir(follow_symlinks=False):
+                    subdirs.append(item.path)
+                    continue
+                if not item.name.lower().endswith('.strm') or not item.is_file():
+                    continue
+                checked += 1
+                mtime = item.stat().st_mtime
+                if records.get(item.name) == (mtime, self.replace_ip):
+                    continue
+                if process_strm_content(item.path, self.replace_ip):
+                    processed += 1
+                    mtime = os.path.getmtime(item.path)
+                self._save_strm_record(join_remote_path(rel_dir, item.name), mtime)
+        return rel_dir, subdirs, checked, processed
+    
     def monitor(self):
         """开始监控WebDAV服务器"""
         logging.info(f"开始监控WebDAV服务器的 {self.remote_dir} 目录，将检查新的文件 (间隔: {self.check_interval}秒)")
-        logging.info(f"使用 {self.max_workers} 个线程进行并行下载")
+        logging.info(f"使用 {self.list_workers} 个线程并行列出目录，{self.max_workers} 个线程进行并行下载")
         
         if self.replace_ip:
             logging.info(f"下载后将自动处理STRM文件内容，替换IP为: {self.replace_ip}")
-            # 首先处理已下载的文件
-            processed_count = self._process_existing_strm_files()
-            if processed_count > 0:
-                logging.info(f"已处理 {processed_count} 个已存在的STRM文件")
+            # 在后台处理已下载的文件，不阻塞扫描
+            self.strm_thread = threading.Thread(target=self._process_existing_strm_files, daemon=True)
+            self.strm_thread.start()
+        
+        # 后台回收空闲连接，长连接在扫描之间保持复用
+        if self.reaper_thread is None:
+            self.reaper_thread = threading.Thread(target=self._reaper, daemon=True)
+            self.reaper_thread.start()
+        
+        # 重建索引完成前扫描会把本地已有的文件全部当作新文件重新下载
+        if not self.index_ready.is_set():
+            logging.info("等待已处理文件索引重建完成后开始扫描...")
+            while not self.index_ready.wait(1) and not self.stop_flag.is_set():
+                pass
         
         try:
             scan_count = 0
-            client_rebuild_interval = 5  # 每 5 次扫描重建一次客户端
+            next_scan_time = time.time()
             
             while not self.stop_flag.is_set():
+                full_requested, paths = self._wait_for_scan(next_scan_time)
+                if self.stop_flag.is_set():
+                    break
+                if paths and not full_requested:
+                    # 只扫描请求的子目录，不影响下次定时扫描的时间
+                    self._scan_subtrees(paths)
+                    continue
+                
                 start_time = time.time()
                 scan_count += 1
-                logging.info(f"开始扫描... (第 {scan_count} 次)")
-                
-                # 定期重建客户端以释放连接资源
-                if scan_count % client_rebuild_interval == 0:
-                    logging.debug("定期重建WebDAV客户端以释放连接资源...")
-                    self.client = self._create_client_with_retry(max_retries=3)
+                next_scan_time = start_time + self.check_interval
+                logging.info(f"开始扫描... (第 {scan_count} 次{'，按请求执行' if full_requested else ''})")
                 
                 # 检查远程目录是否存在
                 try:
                     exists = self.client.check(self.remote_dir)
                     if not exists:
                         logging.error(f"远程目录 {self.remote_dir} 不存在")
-                        time.sleep(self.check_interval)
                         continue
                 except Exception as e:
                     logging.error(f"检查远程目录 {self.remote_dir} 是否存在时出错: {e}")
-                    # 如果出现连接错误，尝试重建客户端
-                    if "Connection pool is full" in str(e):
-                        logging.warning("连接池已满，重建WebDAV客户端...")
-                        self.client = self._create_client_with_retry(max_retries=3)
-                    time.sleep(self.check_interval)
                     continue
                 
+                # 首次扫描(没有目录状态记录)、按请求执行或每隔full_scan_interval次进行完整扫描，其余为增量扫描
+                full_scan = (full_requested or not self.dir_state or self.full_scan_interval <= 1
+                             or scan_count % self.full_scan_interval == 0)
+                if not full_scan:
+                    logging.info("增量扫描：跳过元数据未变化的目录")
+                
                 # 查找所有文件并立即下载
-                download_count, error_count, processed_count, downloaded_files = self._find_and_download_files()
+                download_count, error_count, processed_count, downloaded_files = self._find_and_download_files(full_scan=full_scan)
                 
                 # 更新上次扫描时间
                 self._save_last_scan_time()
                 
+                # 本次扫描下载的文件不必等满一批，扫描结束后立即执行批量命令
+                if self.post_commands is not None:
+                    self.post_commands.flush()
+                
                 elapsed_time = time.time() - start_time
+                self._record_scan(elapsed_time)
                 
                 # 记录扫描结果 - 使用专用报告器确保即使在警告级别下也会显示
-                reporter.report(f"扫描完成 - 耗时: {elapsed_time:.2f}秒，新增文件: {download_count}个，失败: {error_count}个")
+                reporter.report(f"扫描完成 - 耗时: {elapsed_time:.2f}秒，新增文件: {download_count}个，失败: {error_count}个，跳过未变化目录: {self.skipped_dirs}个")
                 
                 # 如果有新增文件，输出文件列表，但保持在INFO级别
                 if download_count > 0 and logging.getLogger().level <= logging.INFO:
-                    logging.info(f"新增文件列表:")
+                    if download_count > len(downloaded_files):
+                        logging.info(f"新增文件列表(最近 {len(downloaded_files)} 个):")
+                    else:
+                        logging.info(f"新增文件列表:")
                     for file_path in downloaded_files:
                         logging.info(f"  - {file_path}")
                 
                 logging.info(f"等待 {self.check_interval} 秒后再次检查...")
-                time.sleep(self.check_interval)
                 
         except KeyboardInterrupt:
             logging.info("监控已停止")
@@ -689,102 +2828,735 @@ class WebdavMonitor:
             # 尝试重新启动监控
             if not self.stop_flag.is_set():
                 logging.info("尝试重新启动监控...")
-                time.sleep(10)
-                self.monitor()
+                if not self.stop_flag.wait(10):
+                    self.monitor()
+    
+    def request_scan(self, path=None):
+        """请求立即扫描，唤醒等待中的监控循环
+
+        :param path: 只扫描该远程子目录(也可以是单个文件)；None或监控根目录表示完整扫描
+        :return: 新加入请求时返回True；已被等待中的请求覆盖(重复请求)时返回False
+        扫描进行中收到的请求合并为当前扫描结束后的一次扫描。
+        """
+        root = '/' + self.remote_dir.strip('/')
+        if path is not None:
+            path = '/' + path.strip('/')
+            if path == root:
+                path = None
+            elif not path.startswith(root.rstrip('/') + '/'):
+                raise ValueError(f"路径 {path} 不在监控目录 {root} 中")
+        
+        with self.scan_condition:
+            if self.scan_full_requested:
+                return False
+            if path is None:
+                self.scan_full_requested = True
+                self.scan_paths = set()
+            else:
+                # 已请求的上级目录扫描会覆盖该目录，新请求覆盖已请求的下级目录
+                if any(path == p or path.startswith(p + '/') for p in self.scan_paths):
+                    return False
+                self.scan_paths = {p for p in self.scan_paths if not p.startswith(path + '/')}
+                self.scan_paths.add(path)
+            self.scan_condition.notify_all()
+        logging.info(f"已请求{'完整扫描' if path is None else '扫描子目录: ' + path}")
+        return True
+    
+    def _wait_for_scan(self, deadline):
+        """等待到下次定时扫描时间，期间收到扫描请求或停止时立即返回
+
+        :return: (是否请求了完整扫描, 请求扫描的子目录列表)，请求被取出后清空
+        """
+        with self.scan_condition:
+            self.scan_condition.wait_for(
+                lambda: self.stop_flag.is_set() or self.scan_full_requested or self.scan_paths,
+                timeout=max(0, deadline - time.time()))
+            full_requested, paths = self.scan_full_requested, sorted(self.scan_paths)
+            self.scan_full_requested = False
+            self.scan_paths = set()
+        return full_requested, paths
+    
+    def _scan_subtrees(self, paths):
+        """按请求扫描指定的子目录，完整列出这些子树并下载其中的新文件"""
+        start_time = time.time()
+        logging.info(f"开始扫描子目录: {', '.join(paths)}")
+        download_count, error_count, _, _ = self._find_and_download_files(paths, full_scan=True)
+        if self.post_commands is not None:
+            self.post_commands.flush()
+        elapsed_time = time.time() - start_time
+        self._record_scan(elapsed_time)
+        reporter.report(f"子目录扫描完成 - 耗时: {elapsed_time:.2f}秒，新增文件: {download_count}个，失败: {error_count}个")
     
     def stop(self):
         """停止监控和下载"""
         logging.info("正在停止监控...")
         self.stop_flag.set()
+        # 唤醒等待下次扫描的监控循环
+        with self.scan_condition:
+            self.scan_condition.notify_all()
         
-        # 刷新剩余的待处理文件
-        self.db_queue.put({'type': 'flush'})
+        # 等待后台STRM处理线程结束当前目录，使其记录能一并写入
+        if self.strm_thread is not None:
+            self.strm_thread.join(timeout=30)
+        
+        # STRM处理线程结束后再通知数据库线程写入剩余记录并退出
+        self.db_queue.put({'type': 'stop'})
         
         # 等待数据库队列处理完成
         logging.info("等待数据库操作完成...")
-        try:
-            self.db_queue.join()
-            self.db_worker_thread.join(timeout=30)
-        except:
-            pass
+        self.db_worker_thread.join(timeout=60)
+        if self.db_worker_thread.is_alive():
+            logging.warning("数据库操作未在60秒内完成")
+        
+        self.segment_executor.shutdown(wait=False)
+        
+        # 执行剩余批次的下载后命令并等待完成
+        if self.post_commands is not None:
+            self.post_commands.close()
+        
+        # 关闭索引的数据库连接，保存过滤器供下次启动直接加载
+        self.processed_files.close()
             
         logging.info("监控器已停止")
 
+    def _db_connect(self):
+        """创建数据库工作线程使用的长连接：WAL模式允许索引查询与写入并发进行"""
+        conn = sqlite3.connect(self.file_tracker, timeout=60)  # 增加超时时间
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL模式下NORMAL只在检查点时同步，断电最多丢失最后几个批次，不会损坏数据库
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-16000")  # 约16MB页缓存
+        ensure_db_schema(conn)
+        self.db_dir_ids = {}
+        return conn
+    
     def _db_worker(self):
-        """数据库工作线程，处理所有数据库写入操作，使用批处理提高效率"""
-        while not self.stop_flag.is_set() or not self.db_queue.empty():
+        """数据库工作线程，持有唯一的写连接，处理所有数据库写入操作，使用批处理提高效率
+
+        只在收到stop任务时退出：停止过程中STRM处理线程等仍可能提交记录，不能因为stop_flag已设置
+        且队列暂时为空就提前退出，否则之后的任务没有线程处理，stop()会一直等待。
+        """
+        # 索引丢失或损坏时从本地已有文件重建，避免重新下载整个媒体库。
+        # 在工作线程中运行，创建监控器(Web界面的启动请求)不用等待遍历整个本地目录
+        try:
+            if self.bootstrap_index == 'force' or (self.bootstrap_index == 'auto' and self.processed_files.count == 0):
+                self._bootstrap_processed_files()
+        except Exception as e:
+            logging.error(f"重建已处理文件索引失败: {e}")
+        finally:
+            self.index_ready.set()
+        
+        # 重放上次运行中写入失败的批次
+        self._db_replay_spill()
+        
+        running = True
+        while running:
             try:
                 # 检查是否需要刷新批处理
                 current_time = time.time()
                 if current_time - self.db_last_flush_time > self.db_flush_interval:
                     with self.db_batch_lock:
-                        if self.pending_files:
+                        if self.pending_files or self.pending_dirs or self.pending_strm:
                             self._db_flush_batch()
                 
                 # 从队列获取任务，短超时以便定期检查刷新
                 try:
-                    task = self.db_queue.get(timeout=2)
+                    task = self.db_queue.get(timeout=min(2, self.db_flush_interval))
                 except queue.Empty:
+                    # 空闲时保存过滤器，下次启动(包括被直接终止后)可以直接加载
+                    self._db_save_filter(idle=True)
                     continue
                 
                 # 处理任务
                 try:
                     if task['type'] == 'save_file':
                         with self.db_batch_lock:
-                            self.pending_files.append(task['file_path'])
+                            self.pending_files.append((task['file_path'], task['meta']))
                             # 如果达到批处理大小，立即刷新
                             if len(self.pending_files) >= self.db_batch_size:
                                 self._db_flush_batch()
-                    elif task['type'] == 'flush':
+                    elif task['type'] == 'save_dir':
+                        with self.db_batch_lock:
+                            self.pending_dirs.append(task['state'])
+                            if len(self.pending_dirs) >= self.db_batch_size:
+                                self._db_flush_batch()
+                    elif task['type'] == 'save_strm':
+                        with self.db_batch_lock:
+                            self.pending_strm.append(task['record'])
+                            if len(self.pending_strm) >= self.db_batch_size:
+                                self._db_flush_batch()
+                    elif task['type'] in ('flush', 'stop'):
                         with self.db_batch_lock:
                             self._db_flush_batch()
+                        running = task['type'] != 'stop'
+                    elif task['type'] == 'save_scan':
+                        self._db_save_scan(task['started_at'], task['report'])
                 except Exception as e:
                     logging.error(f"处理数据库任务出错: {e}")
                 
                 # 标记任务完成
                 self.db_queue.task_done()
+                self._db_save_filter()
                 
             except Exception as e:
                 logging.error(f"数据库工作线程异常: {e}")
                 time.sleep(1)  # 出错后暂停一下
+        
+        if self.db_conn is not None:
+            try:
+                self.db_conn.close()
+            except Exception:
+                pass
+            self.db_conn = None
+    
+    def _db_save_filter(self, idle=False):
+        """有新的批次写入数据库后保存过滤器：空闲时立即保存，持续写入时最多每FILTER_SAVE_INTERVAL秒保存一次"""
+        if self.filter_saved_writes == self.db_writes:
+            return
+        if not idle and time.time() - self.filter_saved_at < FILTER_SAVE_INTERVAL:
+            return
+        self.processed_files.save_filter()
+        self.filter_saved_writes = self.db_writes
+        self.filter_saved_at = time.time()
+    
+    def _db_write(self, file_batch, dir_batch, strm_batch=()):
+        """在一个事务中写入一批文件记录、目录状态和STRM替换记录，失败时抛出异常"""
+        if self.db_conn is None:
+            self.db_conn = self._db_connect()
+        try:
+            with self.db_conn:
+                conn = self.db_conn
+                # 使用批量插入，已存在的记录更新元数据
+                conn.executemany(
+                    "INSERT OR REPLACE INTO files (dir_id, name, etag, size, mtime) VALUES (?, ?, ?, ?, ?)", 
+                    [(get_directory_id(conn, os.path.dirname(path), self.db_dir_ids), os.path.basename(path)) + tuple(meta)
+                     for path, meta in file_batch]
+                )
+                conn.executemany(
+                    "UPDATE directories SET etag = ?, mtime = ?, child_count = ?, check_interval = ?, next_check = ? WHERE id = ?",
+                    [(etag, mtime, child_count, interval, next_check, get_directory_id(conn, path, self.db_dir_ids))
+                     for path, etag, mtime, child_count, interval, next_check in dir_batch]
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO strm_rewrites (dir_id, name, mtime, target) VALUES (?, ?, ?, ?)",
+                    [(get_directory_id(conn, os.path.dirname(path), self.db_dir_ids), os.path.basename(path), mtime, target)
+                     for path, mtime, target in strm_batch]
+                )
+                conn.execute("UPDATE index_meta SET value = value + 1 WHERE key = 'generation'")
+            self.db_writes += 1
+        except Exception:
+            # 回滚后缓存中可能有不存在的目录id；连接也可能已失效，下次写入时重新建立
+            self.db_dir_ids = {}
+            try:
+                self.db_conn.close()
+            except Exception:
+                pass
+            self.db_conn = None
+            raise
+        # 已写入数据库的记录不再需要保留在内存中
+        self.processed_files.forget(file_batch)
+    
+    def _db_save_scan(self, started_at, report):
+        """保存一次扫描的性能报告，只保留最近SCAN_REPORTS_LIMIT条；报告不是必需数据，失败时只记录日志"""
+        if self.db_conn is None:
+            self.db_conn = self._db_connect()
+        try:
+            with self.db_conn:
+                cursor = self.db_conn.execute(
+                    "INSERT INTO scan_reports (started_at, kind, duration, downloads, errors, report) VALUES (?, ?, ?, ?, ?, ?)",
+                    (started_at, report['kind'], report['duration'], report['downloads'], report['errors'],
+                     json.dumps(report, ensure_ascii=False)))
+                self.db_conn.execute("DELETE FROM scan_reports WHERE id <= ?", (cursor.lastrowid - SCAN_REPORTS_LIMIT,))
+            logging.debug(f"已保存扫描报告 #{cursor.lastrowid}")
+        except Exception as e:
+            logging.error(f"保存扫描报告失败: {e}")
+            try:
+                self.db_conn.close()
+            except Exception:
+                pass
+            self.db_conn = None
+            self.db_dir_ids = {}
     
     def _db_flush_batch(self):
-        """将待处理的文件批量写入数据库"""
-        if not self.pending_files:
+        """将待处理的文件和目录状态批量写入数据库"""
+        if not self.pending_files and not self.pending_dirs and not self.pending_strm:
             return
         
-        current_batch = self.pending_files.copy()
+        current_batch = self.pending_files
         self.pending_files = []
+        dir_batch = self.pending_dirs
+        self.pending_dirs = []
+        strm_batch = self.pending_strm
+        self.pending_strm = []
         self.db_last_flush_time = time.time()
         
         # 批量写入数据库
         try:
-            conn = sqlite3.connect(self.file_tracker, timeout=60)  # 增加超时时间
-            cursor = conn.cursor()
-            # 确保表存在
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS processed_files (
-                path TEXT PRIMARY KEY
-            )''')
-            
-            # 使用批量插入
-            cursor.executemany(
-                "INSERT OR IGNORE INTO processed_files (path) VALUES (?)", 
-                [(path,) for path in current_batch]
-            )
-            conn.commit()
-            conn.close()
-            
-            logging.info(f"已批量保存 {len(current_batch)} 个文件记录到数据库")
+            start = time.monotonic()
+            self._db_write(current_batch, dir_batch, strm_batch)
+            self.metrics.observe('webdav_db_flush_seconds', time.monotonic() - start)
+            if current_batch:
+                logging.info(f"已批量保存 {len(current_batch)} 个文件记录到数据库")
+        except Exception as e:
+            logging.error(f"批量保存记录到数据库失败: {e}，写入暂存文件稍后重试")
+            self._db_spill(current_batch, dir_batch, strm_batch)
+            return
+        
+        # 数据库恢复正常后，重试之前失败的批次
+        if os.path.exists(self.db_spill_file):
+            self._db_replay_spill()
+    
+    def _db_spill(self, file_batch, dir_batch, strm_batch=()):
+        """将写入失败的批次追加到暂存文件并同步到磁盘，保证进程退出后也能重放"""
+        try:
+            with open(self.db_spill_file, 'a', encoding='utf-8') as f:
+                for path, meta in file_batch:
+                    f.write(json.dumps({'file': path, 'meta': list(meta)}, ensure_ascii=False) + '\n')
+                for state in dir_batch:
+                    f.write(json.dumps({'dir': list(state)}, ensure_ascii=False) + '\n')
+                for record in strm_batch:
+                    f.write(json.dumps({'strm': list(record)}, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            logging.error(f"写入数据库暂存文件失败: {e}")
+    
+    def _db_replay_spill(self):
+        """将暂存文件(以及旧版本写入的.txt备用文件)中的记录写回数据库，成功后删除文件"""
+        legacy_file = self.file_tracker + ".txt"
+        for spill_file in (self.db_spill_file, legacy_file):
+            if not os.path.exists(spill_file):
+                continue
+            file_batch = []
+            dir_batch = []
+            strm_batch = []
+            try:
+                with open(spill_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        line = line.rstrip('\n')
+                        if not line:
+                            continue
+                        if spill_file == legacy_file:
+                            # 旧版本备用文件每行一个路径，没有元数据
+                            file_batch.append((line, (None, None, None)))
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            # 进程中断可能留下不完整的最后一行
+                            continue
+                        if 'file' in record:
+                            file_batch.append((record['file'], tuple(record['meta'])))
+                        elif 'dir' in record:
+                            # 旧版本暂存的目录状态没有检查间隔和下次检查时间
+                            state = tuple(record['dir'])
+                            dir_batch.append(state + (None,) * (6 - len(state)))
+                        elif 'strm' in record:
+                            strm_batch.append(tuple(record['strm']))
+                
+                # 暂存的记录可能不在启动时构建的过滤器中，先加入索引
+                for path, meta in file_batch:
+                    self.processed_files[path] = meta
+                for i in range(0, max(len(file_batch), len(dir_batch), len(strm_batch)), 5000):
+                    self._db_write(file_batch[i:i + 5000], dir_batch[i:i + 5000], strm_batch[i:i + 5000])
+                os.remove(spill_file)
+                logging.info(f"已从 {os.path.basename(spill_file)} 恢复 {len(file_batch)} 个文件记录到数据库")
+            except Exception as e:
+                logging.error(f"重放 {os.path.basename(spill_file)} 失败: {e}，稍后重试")
+                return
+
+class AsyncWebdavMonitor(WebdavMonitor):
+    """使用asyncio的扫描下载引擎
+
+    目录列出和文件下载都作为协程运行，共享一个保持长连接的aiohttp连接池，
+    同时进行的请求数由async_concurrency控制，不再受线程数和线程栈内存限制。
+    事件循环和连接池在多次扫描之间复用，空闲连接由aiohttp按keepalive_timeout回收。
+    数据库、增量扫描和统计逻辑与线程引擎相同，monitor()/stop()接口不变。
+    """
+    
+    def __init__(self, *args, async_concurrency=100, **kwargs):
+        """
+        :param async_concurrency: 最多同时进行的请求数(列出目录和下载共用)
+        其余参数与WebdavMonitor相同
+        """
+        if aiohttp is None:
+            raise ImportError("asyncio引擎需要安装aiohttp: pip install aiohttp")
+        self.async_concurrency = max(1, async_concurrency)
+        super().__init__(*args, **kwargs)
+        self.async_pool_stats = PoolStats(self.async_concurrency)
+        self.async_downloads = None  # 当前扫描的下载队列，导出队列长度用
+        self.loop = None
+        self.session = None
+    
+    def pool_metrics(self):
+        """返回aiohttp连接池指标"""
+        return self.async_pool_stats.snapshot()
+    
+    def monitor(self):
+        """开始监控WebDAV服务器，结束时关闭连接池和事件循环"""
+        try:
+            super().monitor()
+        finally:
+            self._close_loop()
+    
+    def _close_loop(self):
+        if self.loop is None:
+            return
+        try:
+            if self.session is not None:
+                self.loop.run_until_complete(self.session.close())
+            self.loop.close()
         except Exception as e:
-            logging.error(f"批量保存记录到数据库失败: {e}")
-            # 备用文本文件存储
+            logging.debug(f"关闭事件循环时出错: {e}")
+        self.session = None
+        self.loop = None
+    
+    def _get_session(self):
+        """在当前事件循环中创建(或复用)共享的aiohttp会话"""
+        if self.session is not None:
+            return self.session
+        stats = self.async_pool_stats
+        
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = time.monotonic()
+        
+        async def on_queued_end(session, ctx, params):
+            stats.add('pool_waits')
+            stats.add('pool_wait_seconds', time.monotonic() - ctx.queued_at)
+        
+        async def on_create_end(session, ctx, params):
+            stats.add('connects')
+        
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_queued_start.append(on_queued_start)
+        trace.on_connection_queued_end.append(on_queued_end)
+        trace.on_connection_create_end.append(on_create_end)
+        
+        connector = aiohttp.TCPConnector(limit=self.async_concurrency, limit_per_host=self.async_concurrency,
+                                         keepalive_timeout=self.transport.idle_timeout)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.client_options['webdav_timeout'],
+                                        sock_read=self.client_options['webdav_timeout'])
+        auth = aiohttp.BasicAuth(self.client_options['webdav_login'], self.client_options['webdav_password'])
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout, auth=auth, trace_configs=[trace])
+        return self.session
+    
+    def _find_and_download_files(self, directory=None, full_scan=True):
+        """在事件循环中并发遍历远程目录树，发现的文件立即交给下载协程
+
+        :param directory: 遍历的根目录，也可以是多个目录的列表；默认为remote_dir
+        :param full_scan: 是否完整扫描；为False时跳过元数据未变化的子目录
+        """
+        if directory is None:
+            directory = self.remote_dir
+        directories = [directory] if isinstance(directory, str) else list(directory)
+        self.full_scan = full_scan
+        self._reset_scan_stats(directories, full_scan)
+        
+        if self.depth_infinity:
+            logging.debug("asyncio引擎不使用Depth:infinity，逐目录并发列出")
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self._async_scan(self._scan_roots(directories, full_scan)))
+        
+        return self.download_count, self.error_count, self.processed_count, self.downloaded_files
+    
+    async def _async_scan(self, roots):
+        """启动列表协程和下载协程，直到所有起始目录(DavEntry)下的树遍历完毕且下载队列清空"""
+        session = self._get_session()
+        frontier = asyncio.PriorityQueue()
+        # 下载队列有上限，新文件很多时列表协程会等待下载协程，内存占用保持平稳
+        downloads = asyncio.Queue(maxsize=self.async_concurrency * 10)
+        self.async_downloads = downloads
+        for root in roots:
+            frontier.put_nowait(self._scan_priority(root))
+        
+        listers = [asyncio.ensure_future(self._async_lister(session, frontier, downloads))
+                   for _ in range(self.async_concurrency)]
+        downloaders = [asyncio.ensure_future(self._async_downloader(session, downloads))
+                       for _ in range(self.async_concurrency)]
+        
+        # 子目录在父目录task_done之前入队，所以join返回时整棵树已经遍历完成
+        await frontier.join()
+        await downloads.join()
+        
+        for task in listers + downloaders:
+            task.cancel()
+        await asyncio.gather(*listers, *downloaders, return_exceptions=True)
+    
+    async def _async_lister(self, session, frontier, downloads):
+        """列表协程：列出目录，把子目录放回待扫描队列，把需要下载的文件放入下载队列"""
+        while True:
+            _, _, directory = await frontier.get()
+            try:
+                # 停止时不再列出新目录，只是清空队列，并保证这些目录下次会被重新扫描
+                if self.stop_flag.is_set():
+                    self._invalidate_dir_state(directory)
+                    continue
+                if not self._claim_directory(directory):
+                    continue
+                try:
+                    self.metrics.add('webdav_active_workers', 1, (('role', 'list'),))
+                    start = time.monotonic()
+                    max_retries = 3
+                    for retry_count in range(1, max_retries + 1):
+                        try:
+                            self_entry, entries = await self._async_list_directory(session, directory)
+                            break
+                        except Exception as e:
+                            if retry_count == max_retries or is_not_found(e):
+                                raise
+                            logging.warning(f"列出目录 {directory} 时出错: {e}, 重试 ({retry_count}/{max_retries})")
+                            self.scan_profile.retry('list')
+                            await asyncio.sleep(1)
+                    self.scan_profile.record('list', directory, time.monotonic() - start, len(entries))
+                    directories, files = self._classify_entries(directory, self_entry, entries)
+                except Exception as e:
+                    self._list_failed(directory, e)
+                    continue
+                finally:
+                    self.metrics.add('webdav_active_workers', -1, (('role', 'list'),))
+                for sub_dir in directories:
+                    frontier.put_nowait(self._scan_priority(sub_dir))
+                for entry in files:
+                    await downloads.put(entry)
+            except Exception as e:
+                logging.warning(f"遍历目录时出错: {directory}, {str(e)}")
+            finally:
+                frontier.task_done()
+    
+    async def _async_downloader(self, session, downloads):
+        """下载协程：从下载队列取文件下载"""
+        while True:
+            entry = await downloads.get()
+            try:
+                if self.stop_flag.is_set():
+                    # 停止时放弃剩余下载，保证所在目录下次会被重新扫描
+                    self._invalidate_dir_state(os.path.dirname(entry.path))
+                elif self._needs_download(entry):
+                    self.metrics.add('webdav_active_workers', 1, (('role', 'download'),))
+                    try:
+                        await self._async_download_file(session, entry)
+                    finally:
+                        self.metrics.add('webdav_active_workers', -1, (('role', 'download'),))
+            except Exception as e:
+                logging.error(f"处理下载文件 {entry.path} 时出错: {e}")
+                self._download_failed(entry.path)
+            finally:
+                downloads.task_done()
+    
+    def _request_capacity(self):
+        """同时运行的协程数，即自适应并发上限的默认值"""
+        return self.async_concurrency
+    
+    def _download_queue_depth(self):
+        return self.async_downloads.qsize() if self.async_downloads is not None else 0
+    
+    async def _received_async(self, size):
+        """计入带宽限制和接收字节数"""
+        await self.bandwidth_bucket.acquire_async(size)
+        self.metrics.add('webdav_received_bytes_total', size)
+    
+    @contextlib.asynccontextmanager
+    async def _async_request(self, session, method, url, **kwargs):
+        """经过限速器和并发控制器发送请求，状态码>=400时抛出ResponseErrorCode，结束时把结果反馈给控制器"""
+        await self.request_bucket.acquire_async()
+        await self.operation_buckets['list' if method == 'PROPFIND' else 'download'].acquire_async()
+        await self.concurrency.acquire_async()
+        start = time.monotonic()
+        latency = None
+        overloaded = False
+        retry_after = None
+        status = None
+        try:
+            try:
+                response = await session.request(method, url, **kwargs)
+            except Exception:
+                # 连接失败或超时
+                overloaded = True
+                raise
+            status = response.status
+            elapsed = time.monotonic() - start
+            try:
+                if response.status >= 400:
+                    overloaded = response.status in OVERLOAD_STATUS
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                    if not overloaded:
+                        latency = elapsed
+                    raise ResponseErrorCode(url, response.status, await response.text(errors='replace'))
+                latency = elapsed
+                yield response
+            finally:
+                response.release()
+        finally:
+            await self.concurrency.release_async(latency, overloaded, retry_after,
+                                                 'list' if method == 'PROPFIND' else 'download')
+            self._record_request(method, status, elapsed if status is not None else None)
+    
+    async def _async_list_directory(self, session, directory):
+        """使用一次Depth:1 PROPFIND列出目录，返回值与_list_directory相同"""
+        url = self.client.get_url(Urn(directory, directory=True).quote())
+        headers = {'Depth': '1', 'Content-Type': 'application/xml; charset="utf-8"'}
+        async with self._async_request(session, 'PROPFIND', url, data=PROPFIND_BODY, headers=headers) as response:
+            content = await response.read()
+        await self._received_async(len(content))
+        return self._parse_listing(directory, content)
+    
+    async def _async_download_file(self, session, entry):
+        """下载文件到本地，失败时重试，成功后的处理与线程引擎相同"""
+        remote_path = entry.path
+        local_path = os.path.join(self.local_dir, remote_path.lstrip('/'))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        
+        # 已下载过的文件使用条件请求，内容未变化时服务器只返回304
+        headers = {}
+        for header in self._conditional_headers(remote_path, local_path) or []:
+            name, value = header.split(': ', 1)
+            headers[name] = value
+        
+        # STRM小文件在内存中下载并替换IP，只写一次磁盘
+        in_memory = local_path.lower().endswith('.strm') and (
+            entry.size is None or entry.size <= STRM_INMEMORY_MAX_SIZE)
+        
+        url = self.client.get_url(Urn(remote_path).quote())
+        start = time.monotonic()
+        max_retries = 3
+        for retry_count in range(1, max_retries + 1):
+            try:
+                if in_memory:
+                    modified, strm_processed = await self._async_fetch_strm(session, url, local_path, headers)
+                else:
+                    modified = None
+                    if self._should_segment(entry):
+                        modified = await self._async_fetch_segmented(session, url, local_path, headers, entry)
+                    if modified is None:
+                        modified = await self._async_fetch_file(session, url, local_path, headers, entry)
+                    strm_processed = False
+                break
+            except Exception as e:
+                logging.error(f"下载文件时出错: {e}, 重试 ({retry_count}/{max_retries})")
+                if retry_count == max_retries:
+                    self.scan_profile.record('download', remote_path, time.monotonic() - start, entry.size)
+                    self._download_failed(remote_path)
+                    return False
+                self.scan_profile.retry('download')
+                await asyncio.sleep(1)
+        self.scan_profile.record('download', remote_path, time.monotonic() - start, entry.size)
+        
+        # STRM替换和下载后命令可能较慢，放到线程中执行，不阻塞事件循环
+        start = time.monotonic()
+        try:
+            return await asyncio.to_thread(
+                self._finish_download, remote_path, local_path, entry, modified, strm_processed, in_memory)
+        finally:
+            self.scan_profile.record('post', remote_path, time.monotonic() - start)
+    
+    async def _async_fetch_file(self, session, url, local_path, headers, entry):
+        """用一次GET请求下载文件到.part文件，支持断点续传，含义与_fetch_file相同"""
+        validator = entry_validator(entry)
+        part_path, offset = open_part_file(local_path, validator)
+        headers = dict(headers, **{'Accept-Encoding': 'identity'})
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = validator
+        
+        async with self._async_request(session, 'GET', url, headers=headers) as response:
+            if response.status == 304:
+                return False
+            if response.status == 206 and offset:
+                mode = 'ab'
+                logging.info(f"从 {offset} 字节处继续下载: {entry.path}")
+            else:
+                offset = 0
+                mode = 'wb'
+                start_part_file(part_path, validator)
+            expected_size = offset + response.content_length if response.content_length is not None else entry.size
+            with open(part_path, mode) as f:
+                async for chunk in response.content.iter_chunked(self.client.chunk_size):
+                    await self._received_async(len(chunk))
+                    f.write(chunk)
+        
+        finish_part_file(part_path, local_path, expected_size)
+        return True
+    
+    async def _async_fetch_segmented(self, session, url, local_path, headers, entry):
+        """大文件分段并发下载，含义与_fetch_segmented相同，分段作为协程运行"""
+        workers = self._acquire_segments(entry.size)
+        if workers < 2:
+            self._release_segments(workers)
+            return None
+        try:
+            validator = entry_validator(entry)
+            part_path, done, pending = self._prepare_segments(local_path, validator, entry.size)
+            state = {'lock': threading.Lock(), 'part_path': part_path, 'done': done, 'pending': pending,
+                     'failed': threading.Event(), 'not_modified': False}
+            headers_ext = [f'{name}: {value}' for name, value in headers.items()]
+            fd = os.open(part_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
             try:
-                with open(self.file_tracker + ".txt", 'a') as f:
-                    for path in current_batch:
-                        f.write(f"{path}\n")
-            except Exception as e2:
-                logging.error(f"批量保存记录到文本文件也失败: {e2}")
+                results = await asyncio.gather(
+                    *[self._async_segment_worker(session, url, fd, entry.size, validator, headers_ext, state)
+                      for _ in range(min(workers, len(pending)))],
+                    return_exceptions=True)
+            finally:
+                os.close(fd)
+            return self._finish_segments(part_path, local_path, entry.size, state, results)
+        finally:
+            self._release_segments(workers)
+    
+    async def _async_segment_worker(self, session, url, fd, size, validator, headers_ext, state):
+        """分段下载协程，含义与_segment_worker相同"""
+        while not state['failed'].is_set() and state['pending']:
+            unit = state['pending'].pop(0)
+            start, end, header_lines = self._segment_headers(unit, size, validator, headers_ext)
+            headers = dict(line.split(': ', 1) for line in header_lines)
+            try:
+                async with self._async_request(session, 'GET', url, headers=headers) as response:
+                    if response.status == 304:
+                        state['not_modified'] = True
+                        state['failed'].set()
+                        return
+                    if response.status != 206 or parse_content_range_start(response.headers.get('Content-Range')) != start:
+                        raise SegmentUnsupported()
+                    offset = start
+                    async for chunk in response.content.iter_chunked(self.client.chunk_size):
+                        await self._received_async(len(chunk))
+                        write_at(fd, chunk, offset)
+                        offset += len(chunk)
+                if offset != end + 1:
+                    raise IOError(f"分块下载不完整: {start}-{end}，已接收到 {offset}")
+            except Exception:
+                state['failed'].set()
+                raise
+            state['done'].add(unit)
+            save_segment_progress(state['part_path'], validator, size, state['done'])
+    
+    async def _async_fetch_strm(self, session, url, local_path, headers):
+        """STRM小文件的快速路径，含义与_fetch_strm相同"""
+        async with self._async_request(session, 'GET', url, headers=headers) as response:
+            if response.status == 304:
+                return False, False
+            data = await response.read()
+        await self._received_async(len(data))
+        
+        new_data = rewrite_strm_bytes(data, self.replace_ip)
+        # 与本地内容完全相同时跳过写入，避免无意义的磁盘写和媒体库刷新
+        try:
+            if os.path.getsize(local_path) == len(new_data):
+                with open(local_path, 'rb') as f:
+                    if f.read() == new_data:
+                        return False, False
+        except OSError:
+            pass
+        write_file_atomic(local_path, new_data)
+        return True, new_data != data
+
+def create_monitor(engine='thread', **kwargs):
+    """根据engine创建监控器：thread为线程池引擎，asyncio为协程引擎(需要aiohttp，未安装时回退到线程池引擎)"""
+    async_concurrency = kwargs.pop('async_concurrency', 100)
+    if engine == 'asyncio':
+        if aiohttp is not None:
+            return AsyncWebdavMonitor(async_concurrency=async_concurrency, **kwargs)
+        logging.warning("未安装aiohttp，无法使用asyncio引擎，改用线程池引擎")
+    return WebdavMonitor(**kwargs)
 
 def main():
     parser = argparse.ArgumentParser(description='多线程监控WebDAV服务器并下载文件')
@@ -795,11 +3567,34 @@ def main():
     parser.add_argument('--remote-dir', default='/links/影视', help='远程扫描目录，默认为/links/影视')
     parser.add_argument('--interval', type=int, default=600, help='检查间隔(秒)，默认600秒(10分钟)')
     parser.add_argument('--threads', type=int, default=10, help='下载线程数，默认10个')
-    parser.add_argument('--post-command', help='下载完成后执行的命令，可使用{local_path}占位符')
+    parser.add_argument('--list-threads', type=int, default=4, help='并行列出目录的线程数，默认4个')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread', help='扫描下载引擎：thread(线程池，默认)或asyncio(协程，需要aiohttp)')
+    parser.add_argument('--async-concurrency', type=int, default=100, help='asyncio引擎最多同时进行的请求数，默认100')
+    parser.add_argument('--min-concurrency', type=int, default=2, help='自适应并发控制的最小并发请求数，默认2')
+    parser.add_argument('--max-rps', type=float, default=0, help='每秒最多发送的请求总数，默认不限制')
+    parser.add_argument('--max-propfind-rps', type=float, default=0, help='每秒最多发送的PROPFIND(列出目录)请求数，默认不限制')
+    parser.add_argument('--max-get-rps', type=float, default=0, help='每秒最多发送的GET(下载)请求数，默认不限制')
+    parser.add_argument('--max-bandwidth', default='0', help='下载带宽上限(字节/秒)，可使用K/M/G单位，例如10M，默认不限制')
+    parser.add_argument('--segment-threshold', default='64M', help='大于该大小的文件分段并行下载，可使用K/M/G单位，默认64M；按32M为单位分段，小于32M的设置按32M计算')
+    parser.add_argument('--max-segments', type=int, default=8, help='所有文件同时进行的分段连接总数，小于2表示不分段下载，默认8')
+    parser.add_argument('--segments-per-file', type=int, default=4, help='单个文件最多同时下载的分段数，默认4')
+    parser.add_argument('--max-concurrency', type=int, help='自适应并发控制的最大并发请求数，默认为列表线程数+下载线程数(asyncio引擎为--async-concurrency)')
+    parser.add_argument('--bootstrap-index', choices=['auto', 'force', 'off'], default='auto', help='从本地已有文件重建已处理文件索引：auto(索引为空时，默认)、force(每次启动时)或off')
+    parser.add_argument('--no-bootstrap-reconcile', action='store_true', help='重建索引时不记录本地文件大小，不与远程列表比较，本地已有的文件全部视为已下载')
+    parser.add_argument('--hot-paths', help='优先扫描的远程路径，多个用逗号分隔，例如/links/影视/电视剧；其余目录按修改时间从新到旧扫描')
+    parser.add_argument('--depth-infinity', action='store_true', help='使用Depth:infinity一次获取整棵目录树(适用于alist、rclone serve、nginx-dav等)，服务器拒绝时自动回退')
+    parser.add_argument('--max-dir-interval', type=int, default=86400, help='目录最长检查间隔(秒)，没有变化的目录检查间隔逐次加倍直到该上限，默认86400秒(1天)')
+    parser.add_argument('--full-scan-interval', type=int, default=6, help='每隔多少次扫描进行一次完整扫描，其余扫描跳过未变化的目录，默认6次')
+    parser.add_argument('--post-command', help='下载完成后执行的命令，可使用{local_path}占位符，批量模式可使用{local_paths}占位符')
+    parser.add_argument('--post-command-workers', type=int, default=2, help='同时执行的下载后命令数，默认2')
+    parser.add_argument('--post-command-batch-size', type=int, default=0, help='大于0时批量执行下载后命令，每批最多的文件数；命令包含{local_paths}时默认100，否则路径列表写入标准输入')
+    parser.add_argument('--post-command-batch-window', type=float, default=5, help='批量模式下文件最多等待的秒数，默认5秒')
     parser.add_argument('--replace-ip', help='替换STRM文件中的IP为指定域名，例如: hu.miemiejun.me')
     parser.add_argument('--verbose', action='store_true', help='显示详细日志')
-    parser.add_argument('--pool-connections', type=int, default=20, help='连接池初始连接数，默认20个')
-    parser.add_argument('--pool-maxsize', type=int, default=30, help='连接池最大连接数，默认30个')
+    parser.add_argument('--db-batch-size', type=int, default=200, help='数据库批量写入的记录数，默认200条')
+    parser.add_argument('--db-flush-interval', type=int, default=10, help='数据库自动刷新间隔(秒)，默认10秒')
+    parser.add_argument('--pool-connections', type=int, default=20, help='缓存的主机连接池数，默认20个')
+    parser.add_argument('--pool-maxsize', type=int, help='每个主机的最大连接数，默认为列表线程数+下载线程数+最大分段连接数+2')
     
     args = parser.parse_args()
     
@@ -807,7 +3602,9 @@ def main():
         logging.getLogger().setLevel(logging.DEBUG)
     
     # 初始化监控器
-    monitor = WebdavMonitor(
+    monitor = create_monitor(
+        engine=args.engine,
+        async_concurrency=args.async_concurrency,
         webdav_url=args.url,
         username=args.username,
         password=args.password,
@@ -815,17 +3612,44 @@ def main():
         remote_dir=args.remote_dir,
         check_interval=args.interval,
         max_workers=args.threads,
+        list_workers=args.list_threads,
+        full_scan_interval=args.full_scan_interval,
+        max_dir_interval=args.max_dir_interval,
+        depth_infinity=args.depth_infinity,
+        db_batch_size=args.db_batch_size,
+        db_flush_interval=args.db_flush_interval,
         post_download_command=args.post_command,
+        post_command_workers=args.post_command_workers,
+        post_command_batch_size=args.post_command_batch_size,
+        post_command_batch_window=args.post_command_batch_window,
+        hot_paths=args.hot_paths,
         replace_ip=args.replace_ip,
+        min_concurrency=args.min_concurrency,
+        max_concurrency=args.max_concurrency,
+        max_rps=args.max_rps,
+        max_propfind_rps=args.max_propfind_rps,
+        max_get_rps=args.max_get_rps,
+        max_bandwidth=args.max_bandwidth,
+        segment_threshold=args.segment_threshold,
+        max_segments=args.max_segments,
+        segments_per_file=args.segments_per_file,
+        bootstrap_index=args.bootstrap_index,
+        bootstrap_reconcile=not args.no_bootstrap_reconcile,
         pool_connections=args.pool_connections,
         pool_maxsize=args.pool_maxsize
     )
     
+    # docker stop等发送的SIGTERM按用户中断处理，正常停止并保存索引
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
     try:
         monitor.monitor()
     except KeyboardInterrupt:
-        logging.info("收到用户中断，正在停止监控...")
-        monitor.stop()
+        pass
+    logging.info("收到用户中断，正在停止监控...")
+    monitor.stop()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
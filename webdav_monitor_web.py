@@ -7,8 +7,10 @@ import threading
 import time
 import logging
 import argparse
+import signal
+import sys
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for
 import webdav_monitor_mt as monitor
 
 # 配置日志
@@ -35,11 +37,67 @@ config = {
     "remote_dir": "/",
     "check_interval": 600,
     "max_workers": 10,
+    "list_workers": 4,
+    "full_scan_interval": 6,
+    "max_dir_interval": 86400,
+    "depth_infinity": False,
+    "hot_paths": "",
+    "db_batch_size": 200,
+    "db_flush_interval": 10,
+    "engine": "thread",
+    "async_concurrency": 100,
+    "min_concurrency": 2,
+    "max_concurrency": 0,
+    "max_rps": 0,
+    "max_propfind_rps": 0,
+    "max_get_rps": 0,
+    "max_bandwidth": "0",
+    "segment_threshold": "64M",
+    "max_segments": 8,
+    "segments_per_file": 4,
+    "bootstrap_index": "auto",
+    "bootstrap_reconcile": True,
     "replace_ip": "",
     "post_command": "",
+    "post_command_workers": 2,
+    "post_command_batch_size": 0,
+    "post_command_batch_window": 5,
+    "webhook_token": "",
+    "webhook_debounce": 5,
     "web_port": 8080
 }
 
+# 整数类型的配置项及其默认值，保存时用于类型校验
+INT_CONFIG_DEFAULTS = {
+    "check_interval": 600,
+    "max_workers": 10,
+    "list_workers": 4,
+    "full_scan_interval": 6,
+    "max_dir_interval": 86400,
+    "db_batch_size": 200,
+    "db_flush_interval": 10,
+    "async_concurrency": 100,
+    "min_concurrency": 2,
+    "max_concurrency": 0,
+    "max_segments": 8,
+    "segments_per_file": 4,
+    "post_command_workers": 2,
+    "post_command_batch_size": 0,
+    "webhook_debounce": 5,
+    "web_port": 8080
+}
+
+# 小数类型的配置项及其默认值(每秒请求数可以小于1，批量等待时间可以不足1秒)
+FLOAT_CONFIG_DEFAULTS = {
+    "max_rps": 0,
+    "max_propfind_rps": 0,
+    "max_get_rps": 0,
+    "post_command_batch_window": 5
+}
+
+# 布尔类型的配置项(表单复选框，未勾选时不会出现在表单中)
+BOOL_CONFIG_KEYS = {"depth_infinity", "bootstrap_reconcile"}
+
 # 从环境变量获取日志级别
 if 'LOG_LEVEL' in os.environ:
     log_level_name = os.environ.get('LOG_LEVEL', 'INFO')
@@ -134,18 +192,19 @@ def save_config():
         save_data = config.copy()
         
         # 验证配置数据合法性
-        for key in ["check_interval", "max_workers", "web_port"]:
+        for key, default in INT_CONFIG_DEFAULTS.items():
             if key in save_data and not isinstance(save_data[key], int):
                 try:
                     save_data[key] = int(save_data[key])
                 except (ValueError, TypeError):
                     # 如果无法转换为整数，使用默认值
-                    if key == "check_interval":
-                        save_data[key] = 600
-                    elif key == "max_workers":
-                        save_data[key] = 10
-                    elif key == "web_port":
-                        save_data[key] = 8080
+                    save_data[key] = default
+        for key, default in FLOAT_CONFIG_DEFAULTS.items():
+            if key in save_data and not isinstance(save_data[key], (int, float)):
+                try:
+                    save_data[key] = float(save_data[key])
+                except (ValueError, TypeError):
+                    save_data[key] = default
         
         # 确保配置目录存在
         config_dir = os.path.dirname(config_file)
@@ -192,7 +251,20 @@ def start_monitor():
         return False
     
     try:
-        webdav_monitor = monitor.WebdavMonitor(
+        webdav_monitor = monitor.create_monitor(
+            engine=config["engine"],
+            async_concurrency=config["async_concurrency"],
+            min_concurrency=config["min_concurrency"],
+            max_concurrency=config["max_concurrency"] or None,
+            max_rps=config["max_rps"],
+            max_propfind_rps=config["max_propfind_rps"],
+            max_get_rps=config["max_get_rps"],
+            max_bandwidth=config["max_bandwidth"],
+            segment_threshold=config["segment_threshold"],
+            max_segments=config["max_segments"],
+            segments_per_file=config["segments_per_file"],
+            bootstrap_index=config["bootstrap_index"],
+            bootstrap_reconcile=bool(config["bootstrap_reconcile"]),
             webdav_url=config["webdav_url"],
             username=config["username"],
             password=config["password"],
@@ -200,7 +272,17 @@ def start_monitor():
             remote_dir=config["remote_dir"],
             check_interval=config["check_interval"],
             max_workers=config["max_workers"],
+            list_workers=config["list_workers"],
+            full_scan_interval=config["full_scan_interval"],
+            max_dir_interval=config["max_dir_interval"],
+            depth_infinity=bool(config["depth_infinity"]),
+            hot_paths=config["hot_paths"],
+            db_batch_size=config["db_batch_size"],
+            db_flush_interval=config["db_flush_interval"],
             post_download_command=config["post_command"],
+            post_command_workers=config["post_command_workers"],
+            post_command_batch_size=config["post_command_batch_size"],
+            post_command_batch_window=config["post_command_batch_window"],
             replace_ip=config["replace_ip"]
         )
         
@@ -229,6 +311,75 @@ def stop_monitor():
             logging.error(f"停止监控时出错: {e}")
     return False
 
+class WebhookDebouncer:
+    """合并短时间内收到的变更通知
+
+    收到通知后等待delay秒，期间又有新通知时重新计时(最多等待max_wait秒)，
+    然后把合并后的路径交给监控器扫描；已包含在其他路径中的子路径只扫描一次。
+    """
+    
+    def __init__(self, max_wait=60):
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.first_time = None
+        self.timer = None
+    
+    def add(self, paths, delay):
+        """加入变更路径，返回等待扫描的路径数"""
+        with self.lock:
+            now = time.time()
+            if not self.paths:
+                self.first_time = now
+            self.paths.update('/' + path.strip('/') for path in paths)
+            if self.timer is not None:
+                self.timer.cancel()
+            # 持续收到通知时不无限推迟，最多等待max_wait秒
+            wait = max(0, min(delay, self.first_time + self.max_wait - now))
+            self.timer = threading.Timer(wait, self.fire)
+            self.timer.daemon = True
+            self.timer.start()
+            return len(self.paths)
+    
+    def fire(self):
+        """请求扫描合并后的路径"""
+        with self.lock:
+            paths = sorted(self.paths)
+            self.paths = set()
+            self.timer = None
+        if not paths:
+            return
+        # 排序后上级路径在前，跳过已被上级路径覆盖的子路径
+        merged = []
+        for path in paths:
+            if not any(path == p or path.startswith(p.rstrip('/') + '/') for p in merged):
+                merged.append(path)
+        if not webdav_monitor:
+            logging.warning(f"监控未运行，忽略 {len(merged)} 个变更通知路径")
+            return
+        logging.info(f"变更通知：请求扫描 {len(merged)} 个路径")
+        for path in merged:
+            try:
+                webdav_monitor.request_scan(path)
+            except ValueError as e:
+                logging.warning(f"忽略变更通知路径: {e}")
+
+webhook_debouncer = WebhookDebouncer()
+
+def parse_webhook_paths():
+    """从变更通知请求中取出路径：JSON的path/paths字段或路径数组，也可以是表单或查询参数中的path"""
+    data = request.get_json(silent=True)
+    paths = []
+    if isinstance(data, dict):
+        if isinstance(data.get("path"), str):
+            paths.append(data["path"])
+        if isinstance(data.get("paths"), list):
+            paths.extend(path for path in data["paths"] if isinstance(path, str))
+    elif isinstance(data, list):
+        paths.extend(path for path in data if isinstance(path, str))
+    paths.extend(request.values.getlist("path"))
+    return [path for path in paths if path.strip()]
+
 @app.route('/')
 def index():
     """网页首页"""
@@ -271,13 +422,20 @@ def api_save_config():
     
     # 从请求中获取配置
     for key in config:
-        if key in request.form:
+        if key in BOOL_CONFIG_KEYS:
+            config[key] = key in request.form
+        elif key in request.form:
             # 转换数值类型
-            if key in ["check_interval", "max_workers", "web_port"]:
+            if key in INT_CONFIG_DEFAULTS:
                 try:
                     config[key] = int(request.form[key])
                 except:
                     pass
+            elif key in FLOAT_CONFIG_DEFAULTS:
+                try:
+                    config[key] = float(request.form[key])
+                except ValueError:
+                    pass
             else:
                 config[key] = request.form[key]
     
@@ -309,12 +467,81 @@ def api_status():
         stats["processed_count"] = getattr(webdav_monitor, "processed_count", 0)
         stats["error_count"] = getattr(webdav_monitor, "error_count", 0)
         
-        # 获取最近下载的文件
-        downloaded_files = getattr(webdav_monitor, "downloaded_files", [])
-        stats["recent_files"] = downloaded_files[-10:] if downloaded_files else []
+        # 获取最近下载的文件(下载线程持有stats_lock追加，复制时加锁避免迭代中被修改)
+        with webdav_monitor.stats_lock:
+            downloaded_files = list(getattr(webdav_monitor, "downloaded_files", []))
+        stats["recent_files"] = downloaded_files[-10:]
+        
+        # 连接池指标：建立连接数、等待空闲连接次数和耗时、回收的空闲连接数
+        stats["connection_pool"] = webdav_monitor.pool_metrics()
+        # 自适应并发控制器的当前并发上限、延迟和限流统计
+        stats["concurrency"] = webdav_monitor.concurrency.snapshot()
+        # 请求速率和带宽限速器的累计等待时间
+        stats["rate_limits"] = webdav_monitor.rate_limits()
+        # 下载后命令的执行次数、失败次数、耗时和最近的退出码
+        if webdav_monitor.post_commands is not None:
+            stats["post_commands"] = webdav_monitor.post_commands.snapshot()
     
     return jsonify(stats)
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus指标：请求延迟、接收字节数、数据库写入和扫描耗时等累计值，以及队列长度和工作线程数"""
+    if not webdav_monitor:
+        return Response("", mimetype="text/plain")
+    return Response(webdav_monitor.metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+def scan_db_path():
+    """扫描报告所在的记录数据库，监控未启动时按配置的本地目录查找"""
+    if webdav_monitor:
+        return webdav_monitor.file_tracker
+    return os.path.join(config["local_dir"], ".processed_files.db")
+
+@app.route('/api/scans')
+def api_scans():
+    """API: 最近的扫描报告摘要，?limit=返回条数(默认50)，?before=id用于翻页"""
+    try:
+        limit = min(max(int(request.args.get("limit", 50)), 1), 500)
+        before = request.args.get("before")
+        before = int(before) if before else None
+    except ValueError:
+        return jsonify({"success": False, "message": "参数必须是整数"}), 400
+    return jsonify(monitor.load_scan_reports(scan_db_path(), limit, before))
+
+@app.route('/api/scans/<int:scan_id>')
+def api_scan_report(scan_id):
+    """API: 一次扫描的完整报告，包括最慢的目录和文件"""
+    report = monitor.load_scan_report(scan_db_path(), scan_id)
+    if report is None:
+        return jsonify({"success": False, "message": "扫描报告不存在"}), 404
+    return jsonify(report)
+
+@app.route('/api/scan', methods=['POST'])
+def api_scan():
+    """API: 立即扫描，可用?path=只扫描某个子目录；扫描进行中的重复请求会被合并"""
+    if not webdav_monitor or not (monitor_thread and monitor_thread.is_alive()):
+        return jsonify({"success": False, "message": "监控未运行"}), 409
+    path = request.args.get("path") or None
+    try:
+        queued = webdav_monitor.request_scan(path)
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({"success": True, "queued": queued, "path": path})
+
+@app.route('/api/webhook', methods=['POST'])
+def api_webhook():
+    """API: 接收上游(alist、CloudDrive2等)的文件变更通知，合并后只扫描变化的路径"""
+    token = config.get("webhook_token")
+    if token and request.headers.get("X-Webhook-Token", request.args.get("token")) != token:
+        return jsonify({"success": False, "message": "token无效"}), 403
+    if not webdav_monitor or not (monitor_thread and monitor_thread.is_alive()):
+        return jsonify({"success": False, "message": "监控未运行"}), 409
+    paths = parse_webhook_paths()
+    if not paths:
+        return jsonify({"success": False, "message": "没有提供路径"}), 400
+    pending = webhook_debouncer.add(paths, config["webhook_debounce"])
+    return jsonify({"success": True, "accepted": len(paths), "pending": pending})
+
 @app.route('/api/restart', methods=['POST'])
 def api_restart():
     """API: 重启监控"""
@@ -352,6 +579,13 @@ def main():
     else:
         logging.info("WebDAV配置不完整，但继续启动Web界面。请在Web界面完成配置后启动监控")
     
+    # docker stop等发送SIGTERM时先停止监控，写入剩余记录并保存索引
+    def handle_sigterm(signum, frame):
+        logging.info("收到终止信号，正在停止...")
+        stop_monitor()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    
     # 启动Web服务
     logging.info(f"Web服务启动在端口: {config['web_port']}")
     app.run(host='0.0.0.0', port=config["web_port"], debug=False)